@@ -1,6 +1,21 @@
+import email.utils
+import json
 import logging
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .throttle import (
+    AdaptiveLimiter, LatencyStats, SingleFlight, Slot, TokenBucket)
 
 # http://stackoverflow.com/a/28002687/98491
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -9,47 +24,470 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 log = logging.getLogger(__name__)
 
 
+# Timeouts of a request, in seconds (None for no timeout): to connect, between
+# two reads of the response, and for the whole exchange
+Timeouts = namedtuple('Timeouts', ['connect', 'read', 'total'])
+
+
+def _close_response(future):
+    # discard the response of an abandoned request, freeing its connection
+    if not future.exception():
+        future.result().close()
+
+
+class _Recovered:
+    """ Stands for the response of a request whose result was recovered
+    """
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = {}
+
+    def json(self):
+        return self.data
+
+
+def _not_processed(error):
+    """ Tells if a failed request surely did not reach the application
+    """
+    if isinstance(error, requests.HTTPError):
+        # rate limited requests are rejected before being processed
+        return error.response.status_code == 429
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
 class APIClient:
-    def __init__(self, api_key, verify):
+    # Max number of pooled connections kept open per host
+    POOL_SIZE = 10
+    # Max number of pages of a listing fetched concurrently
+    PAGE_WORKERS = 4
+    # Max number of times a failed request is sent again
+    RETRIES = 5
+    # Base and max delay (in seconds) of the exponential backoff
+    BACKOFF = 0.5
+    MAX_BACKOFF = 60
+
+    # Responses worth retrying: rate limiting and transient server errors
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # Methods which can be sent again without side effects
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+    TIMEOUTS = Timeouts(connect=10, read=120, total=None)
+    # Percentile of an endpoint latencies after which a GET is hedged
+    HEDGE_PERCENTILE = 95
+
+    def __init__(self, api_key, verify, pool_size=POOL_SIZE, keep_alive=True,
+                 page_workers=PAGE_WORKERS, retries=RETRIES, backoff=BACKOFF,
+                 adaptive=False, identity_rate=None, timeouts=TIMEOUTS,
+                 endpoint_timeouts=(), hedge=False, memo_ttl=None):
         self.api_key = api_key
         self.verify = verify
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.page_workers = page_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.adaptive = adaptive
+        self.identity_rate = identity_rate
+        self.timeouts = timeouts
+        self.endpoint_timeouts = [
+            (re.compile(pattern), t) for pattern, t in endpoint_timeouts]
+        self.hedge = hedge
+
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        # hosts whose rate limit is exhausted, with the time it resets
+        self._paused_until = {}
+        self._limiters = {}
+        self._buckets = {}
+        self._latencies = LatencyStats()
+        self._single_flight = SingleFlight(memo_ttl)
+        self._executor = None
+
+    def get_session(self, url):
+        """ Returns the pooled session dedicated to the host of an URL
+
+        Sessions are created lazily, one per host, so that TCP and TLS
+        connections are reused across requests instead of being opened for
+        each call.
+
+        :param url: any URL on the target host
+        :rtype: requests.Session
+        """
+        host = urlsplit(url).netloc
+        with self._sessions_lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self._sessions[host] = session
+        return session
+
+    def get_limiter(self, host):
+        """ Returns the adaptive concurrency limiter of a host
 
-    def get_auth_headers(self):
+        :return: an AdaptiveLimiter, None if adaptive concurrency is off
+        """
+        if not self.adaptive:
+            return None
+        with self._sessions_lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = AdaptiveLimiter(host, maximum=self.pool_size)
+                self._limiters[host] = limiter
+        return limiter
+
+    def get_bucket(self, api_key):
+        """ Returns the token bucket of an impersonated identity
+
+        Servers rate-limit each user, so requests sent with the users own
+        keys (rather than the client one) are throttled per user.
+
+        :return: a TokenBucket, None if the requests are not throttled
+        """
+        if self.identity_rate is None or api_key in (None, self.api_key):
+            return None
+        with self._sessions_lock:
+            bucket = self._buckets.get(api_key)
+            if bucket is None:
+                bucket = TokenBucket(self.identity_rate)
+                self._buckets[api_key] = bucket
+        return bucket
+
+    def identity_delay(self, api_key):
+        """ Returns how long a request with ``api_key`` would be throttled
+        """
+        bucket = self.get_bucket(api_key)
+        return 0 if bucket is None else bucket.delay()
+
+    def get_timeouts(self, url):
+        """ Returns the timeouts of the first endpoint pattern matching url
+
+        :rtype: Timeouts
+        """
+        for pattern, timeouts in self.endpoint_timeouts:
+            if pattern.search(url):
+                return timeouts
+        return self.timeouts
+
+    def close(self):
+        """ Closes all pooled connections
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def get_auth_headers(self, api_key, sudo=None):
         """ Method to be overloaded by child classes
 
+        :param api_key: the API key to authenticate with
+        :param sudo: if set, the user to impersonate
         :return: a dict with auth headers set
         """
         return {}
 
-    def add_auth_headers(self, kwargs):
+    def add_auth_headers(self, kwargs, api_key=None, sudo=None):
+        """ Returns request kwargs with auth headers set
+
+        Credentials are given per request, the client itself is never
+        modified, so that it can be shared between threads.
+
+        :param api_key: API key to use instead of the client one
+        :param sudo: user to impersonate
+        """
         _kwargs = kwargs.copy()
-        headers = kwargs.get('headers', {})
-        headers.update(self.get_auth_headers())
+        headers = dict(kwargs.get('headers', {}))
+        headers.update(self.get_auth_headers(api_key or self.api_key, sudo))
         _kwargs['headers'] = headers
         _kwargs['verify'] = self.verify
         return _kwargs
 
-    def _req(self, func, *args, **kwargs):
-        log.debug('HTTP REQUEST {} {} {}'.format(
-            func, args, kwargs))
-        kwargs = self.add_auth_headers(kwargs)
-        resp = func(*args, **kwargs)
-        resp.raise_for_status()
-        ret = resp.json()
+    def retry_delay(self, attempt, resp=None):
+        """ Returns how long to wait before sending a failed request again
+
+        The server hints (``Retry-After``, or an exhausted
+        ``RateLimit-Remaining`` along with ``RateLimit-Reset``) are followed
+        when given, otherwise the delay grows exponentially with attempts,
+        with a full jitter so that concurrent workers do not retry at once.
+
+        :param attempt: number of the retry, starting at 0
+        :param resp: the failed response, if any
+        """
+        if resp is not None:
+            retry_after = resp.headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    return max(0, float(retry_after))
+                except ValueError:
+                    pass
+                try:
+                    date = email.utils.parsedate_to_datetime(retry_after)
+                    return max(0, date.timestamp() - time.time())
+                except (TypeError, ValueError):
+                    log.debug('Ignoring invalid Retry-After: {}'.format(
+                        retry_after))
+
+            reset = self._rate_limit_reset(resp)
+            if reset is not None:
+                return max(0, reset - time.time())
+
+        return random.uniform(
+            0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def _rate_limit_reset(self, resp):
+        """ Returns the time the rate limit resets, if exhausted
+        """
+        if resp.headers.get('RateLimit-Remaining') != '0':
+            return None
+        try:
+            return float(resp.headers['RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return None
+
+    def _wait_rate_limit(self, host):
+        with self._sessions_lock:
+            paused_until = self._paused_until.get(host, 0)
+        delay = paused_until - time.time()
+        if delay > 0:
+            log.info('Rate limit of {} exhausted, waiting {:.1f}s'.format(
+                host, delay))
+            time.sleep(delay)
+
+    def _pause(self, host, bucket, until):
+        """ Holds the requests of an identity, or else to a host, until a time
+        """
+        if bucket is not None:
+            bucket.drain(until - time.time())
+        else:
+            with self._sessions_lock:
+                self._paused_until[host] = until
+
+    def _send(self, method, url, *args, idempotent=None, recover=None,
+              bucket=None, **kwargs):
+        """ Sends a request, sending it again on transient failures
+
+        Idempotent requests are retried on connection errors and on
+        RETRY_STATUSES. Other requests are only retried when they surely
+        were not processed (rate limited, or connection refused); otherwise,
+        ``recover`` is called to look for their result, and they are only
+        sent again if it is not found.
+
+        :param idempotent: overrides the guess made from the method
+        :param recover: callable returning the result of a request which
+            may have been processed, or None if it was not
+        :param bucket: TokenBucket of the identity sending the request, if
+            throttled per identity rather than per host
+        :return: the HTTP response, when successful
+        """
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        host = urlsplit(url).netloc
+        session = self.get_session(url)
+
+        for attempt in range(self.retries + 1):
+            if bucket is not None:
+                bucket.take()
+            else:
+                self._wait_rate_limit(host)
+            limiter = self.get_limiter(host)
+            try:
+                with limiter.slot() if limiter else nullcontext(Slot()) as slot:
+                    resp = self._send_once(
+                        session, method, url, *args, **kwargs)
+                    slot.ok = (resp.status_code < 500
+                               and resp.status_code != 429)
+                reset = self._rate_limit_reset(resp)
+                if reset is not None:
+                    self._pause(host, bucket, reset)
+                resp.raise_for_status()
+                return resp
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.HTTPError) as e:
+                resp = getattr(e, 'response', None)
+                if (attempt == self.retries
+                        or resp is not None
+                        and resp.status_code not in self.RETRY_STATUSES):
+                    raise
+
+                if not idempotent and not _not_processed(e):
+                    if recover is None:
+                        raise
+                    # the request might have been processed anyway
+                    recovered = recover()
+                    if recovered is not None:
+                        log.info('{} {} failed ({}), but was processed'.format(
+                            method, url, e))
+                        return _Recovered(recovered)
+
+                delay = self.retry_delay(attempt, resp)
+                if resp is not None and resp.status_code == 429:
+                    # hold the other requests of the identity as well
+                    self._pause(host, bucket, time.time() + delay)
+                log.warning('{} {} failed ({}), retrying in {:.1f}s ({}/{})'.format(
+                    method, url, e, delay, attempt + 1, self.retries))
+                time.sleep(delay)
+
+    def _send_once(self, session, method, url, *args, **kwargs):
+        """ Sends a request once, within its endpoint timeouts
+
+        GETs are hedged, if enabled: when the response takes longer than
+        most of the previous ones to the endpoint, the request is sent a
+        second time, and the first response is used.
+        """
+        timeouts = self.get_timeouts(url)
+        kwargs.setdefault('timeout', (timeouts.connect, timeouts.read))
+        # latencies are tracked per endpoint, regardless of ids
+        endpoint = '{} {}'.format(
+            method, re.sub(r'\d+', ':id', urlsplit(url).path))
+        hedge_after = None
+        if self.hedge and method == 'GET':
+            hedge_after = self._latencies.percentile(
+                endpoint, self.HEDGE_PERCENTILE)
+
+        start = time.perf_counter()
+        # a request body being sent can't be abandoned, it would be read
+        # again by a retry
+        streamed_body = not isinstance(kwargs.get('data'), (dict, type(None)))
+        if hedge_after is None and (timeouts.total is None or streamed_body):
+            resp = session.request(method, url, *args, **kwargs)
+        else:
+            resp = self._send_deadline(
+                session, method, url, args, kwargs, timeouts.total,
+                hedge_after)
+        self._latencies.add(endpoint, time.perf_counter() - start)
+        return resp
+
+    def _send_deadline(self, session, method, url, args, kwargs, total,
+                       hedge_after):
+        """ Sends a request from a background thread, waiting at most total
+
+        :param hedge_after: if set, delay after which the request is sent
+            again, if still waiting
+        """
+        with self._sessions_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=4 * self.pool_size)
+        deadline = None if total is None else time.perf_counter() + total
+
+        def remaining(limit=None):
+            if deadline is None:
+                return limit
+            left = max(0, deadline - time.perf_counter())
+            return left if limit is None else min(left, limit)
+
+        def send():
+            return session.request(method, url, *args, **kwargs)
+
+        pending = {self._executor.submit(send)}
+        if hedge_after is not None:
+            done, pending = wait(pending, timeout=remaining(hedge_after))
+            if not done and remaining() != 0:
+                log.debug('Hedging {} {}, no response after {:.2f}s'.format(
+                    method, url, hedge_after))
+                pending.add(self._executor.submit(send))
+            pending |= done
+
+        error = None
+        while pending:
+            done, pending = wait(
+                pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    resp = future.result()
+                except requests.RequestException as e:
+                    error = e
+                    continue
+                for other in pending | (done - {future}):
+                    other.add_done_callback(_close_response)
+                return resp
+
+        if not pending:
+            raise error
+        for other in pending:
+            other.add_done_callback(_close_response)
+        raise requests.Timeout('{} {} got no response within {}s'.format(
+            method, url, total))
+
+    def _request(self, method, url, *args, api_key=None, sudo=None, **kwargs):
+        """ Sends an authenticated request
+
+        :param api_key: API key to use instead of the client one
+        :param sudo: user to impersonate
+        :return: the HTTP response, when successful, see _send() for the
+            other parameters
+        :rtype: requests.Response
+        """
+        log.debug('HTTP REQUEST {} {} {} {}'.format(
+            method, url, args, kwargs))
+        kwargs = self.add_auth_headers(kwargs, api_key, sudo)
+        try:
+            return self._send(
+                method, url, *args, bucket=self.get_bucket(api_key), **kwargs)
+        finally:
+            if method not in ('GET', 'HEAD'):
+                # memoized results may be outdated by the change
+                self._single_flight.clear()
+
+    def _req(self, method, url, *args, **kwargs):
+        ret = self._request(method, url, *args, **kwargs).json()
         log.debug('HTTP RESPONSE {}'.format(ret))
         return ret
 
-    def get(self, *args, **kwargs):
-        return self._req(requests.get, *args, **kwargs)
+    def shared(self, key, func):
+        """ Calls func, unless a call with the same key is running
 
-    def post(self, *args, **kwargs):
-        return self._req(requests.post, *args, **kwargs)
+        Concurrent calls with the same key share a single call, and its
+        result, memoized for a while if the client has a memo_ttl. The
+        result is shared, it must not be altered.
+        """
+        return self._single_flight.do(key, func)
+
+    def get(self, url, **kwargs):
+        """ GET a resource, concurrent identical GETs sharing a single request
+        """
+        key = 'GET {} {}'.format(
+            url, json.dumps(kwargs, sort_keys=True, default=str))
+        return self.shared(key, lambda: self._get(url, **kwargs))
+
+    def _get(self, url, **kwargs):
+        return self._req('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self._req('POST', url, data=data, **kwargs)
 
-    def put(self, *args, **kwargs):
-        return self._req(requests.put, *args, **kwargs)
+    def put(self, url, data=None, **kwargs):
+        return self._req('PUT', url, data=data, **kwargs)
 
-    def delete(self, *args, **kwargs):
-        return self._req(requests.delete, *args, **kwargs)
+    def delete(self, url, **kwargs):
+        return self._req('DELETE', url, **kwargs)
+
+    def open(self, url):
+        """ Opens a raw, unauthenticated download stream on the pooled session
+
+        Used for fetching attachments: the API auth headers are not sent, as
+        the target host may differ from the API one.
+
+        :return: a file-like object
+        """
+        log.debug('HTTP DOWNLOAD {}'.format(url))
+        resp = self._send('GET', url, stream=True, verify=self.verify)
+        resp.raw.decode_content = True
+        return resp.raw
 
 
 class Project:
@@ -0,0 +1,636 @@
+""" asyncio counterparts of the API clients, and of the projects hot paths
+
+Thousands of requests can be in flight in a single process, without a thread
+per request. Requires aiohttp (``pip install redmine-gitlab-migrator[async]``).
+
+Project setup (ids resolution, milestones, members...) is left to the
+synchronous classes, the async ones wrap them for the per-issue work.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import tempfile
+from collections import deque, namedtuple
+from itertools import chain, islice
+
+import aiohttp
+
+from . import APIClient
+from .gitlab import GitlabClient, _same_date
+from .multipart import Transfer
+from .redmine import RedmineClient, RedmineUsersIndex, issue_user_ids
+
+log = logging.getLogger(__name__)
+
+# A decoded response
+Response = namedtuple('Response', ['status', 'headers', 'links', 'data'])
+
+# aiohttp >= 3.10 tells connection timeouts apart
+_CONNECT_ERRORS = (aiohttp.ClientConnectorError,) + tuple(
+    getattr(aiohttp, i) for i in ('ConnectionTimeoutError',)
+    if hasattr(aiohttp, i))
+
+
+def _not_processed(error):
+    """ Tells if a failed request surely did not reach the application
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        # rate limited requests are rejected before being processed
+        return error.status == 429
+    return isinstance(error, _CONNECT_ERRORS)
+
+
+class AsyncAPIClient:
+    """ asyncio counterpart of APIClient
+
+    Requests are retried the same way: idempotent ones on connection errors
+    and APIClient.RETRY_STATUSES, others only when they surely were not
+    processed, or when ``recover`` does not find their result. HTTP errors
+    are raised as aiohttp.ClientResponseError.
+
+    To be used as an async context manager, which closes the connections.
+    """
+    # Max number of requests in flight, all hosts together
+    MAX_IN_FLIGHT = 100
+
+    RETRY_STATUSES = APIClient.RETRY_STATUSES
+    IDEMPOTENT_METHODS = APIClient.IDEMPOTENT_METHODS
+    MAX_BACKOFF = APIClient.MAX_BACKOFF
+
+    # same delays and auth as the synchronous client
+    retry_delay = APIClient.retry_delay
+    _rate_limit_reset = APIClient._rate_limit_reset
+    get_timeouts = APIClient.get_timeouts
+    get_auth_headers = APIClient.get_auth_headers
+
+    def __init__(self, api_key, verify, max_in_flight=MAX_IN_FLIGHT,
+                 retries=APIClient.RETRIES, backoff=APIClient.BACKOFF,
+                 timeouts=APIClient.TIMEOUTS, endpoint_timeouts=()):
+        self.api_key = api_key
+        self.verify = verify
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = timeouts
+        self.endpoint_timeouts = [
+            (re.compile(pattern), t) for pattern, t in endpoint_timeouts]
+        self._session = None
+
+    def get_session(self):
+        """ Returns the session, created on first use within the event loop
+
+        :rtype: aiohttp.ClientSession
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_in_flight, ssl=None if self.verify else False)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _send(self, method, url, read, idempotent=None, recover=None,
+                    data=None, **kwargs):
+        """ Sends a request, sending it again on transient failures
+
+        :param read: coroutine function reading the aiohttp response
+        :param data: request body, or a callable returning it, to build a
+            fresh body for each attempt (e.g. for multipart uploads)
+        :param recover: coroutine function returning the result of a
+            request which may have been processed, or None if it was not
+        :return: what read() returned, or the recovered result
+        """
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        t = self.get_timeouts(url)
+        timeout = aiohttp.ClientTimeout(
+            total=t.total, sock_connect=t.connect, sock_read=t.read)
+
+        for attempt in range(self.retries + 1):
+            resp = None
+            try:
+                async with self.get_session().request(
+                        method, url, timeout=timeout,
+                        data=data() if callable(data) else data,
+                        **kwargs) as resp:
+                    resp.raise_for_status()
+                    return await read(resp)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = getattr(e, 'status', None)
+                if (attempt == self.retries or status is not None
+                        and status not in self.RETRY_STATUSES):
+                    raise
+
+                if not idempotent and not _not_processed(e):
+                    if recover is None:
+                        raise
+                    # the request might have been processed anyway
+                    recovered = await recover()
+                    if recovered is not None:
+                        log.info('{} {} failed ({}), but was processed'.format(
+                            method, url, e))
+                        return recovered
+
+                delay = self.retry_delay(attempt, resp)
+                log.warning('{} {} failed ({}), retrying in {:.1f}s ({}/{})'.format(
+                    method, url, e, delay, attempt + 1, self.retries))
+                await asyncio.sleep(delay)
+
+    async def _request(self, method, url, api_key=None, sudo=None, **kwargs):
+        """ Sends an authenticated request
+
+        :param api_key: API key to use instead of the client one
+        :param sudo: user to impersonate
+        :return: the decoded response, see _send() for the other parameters
+        :rtype: Response
+        """
+        log.debug('HTTP REQUEST {} {} {}'.format(method, url, kwargs))
+        headers = dict(kwargs.pop('headers', {}))
+        headers.update(self.get_auth_headers(api_key or self.api_key, sudo))
+
+        async def read(resp):
+            text = await resp.text()
+            return Response(
+                resp.status, resp.headers,
+                {rel: str(link['url']) for rel, link in resp.links.items()},
+                json.loads(text) if text else None)
+
+        resp = await self._send(method, url, read, headers=headers, **kwargs)
+        if not isinstance(resp, Response):
+            # recovered result
+            resp = Response(200, {}, {}, resp)
+        return resp
+
+    async def _req(self, method, url, **kwargs):
+        ret = (await self._request(method, url, **kwargs)).data
+        log.debug('HTTP RESPONSE {}'.format(ret))
+        return ret
+
+    async def get(self, url, **kwargs):
+        return await self._req('GET', url, **kwargs)
+
+    async def post(self, url, data=None, **kwargs):
+        return await self._req('POST', url, data=data, **kwargs)
+
+    async def put(self, url, data=None, **kwargs):
+        return await self._req('PUT', url, data=data, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self._req('DELETE', url, **kwargs)
+
+    async def download(self, url, fileobj):
+        """ Downloads an URL into a file-like object, unauthenticated
+
+        :return: the number of bytes downloaded
+        """
+        async def read(resp):
+            fileobj.seek(0)
+            fileobj.truncate()
+            size = 0
+            async for chunk in resp.content.iter_chunked(1024 * 1024):
+                fileobj.write(chunk)
+                size += len(chunk)
+            return size
+
+        return await self._send('GET', url, read)
+
+
+class AsyncRedmineClient(AsyncAPIClient):
+    """ asyncio counterpart of RedmineClient
+    """
+    PAGE_MAX_SIZE = RedmineClient.PAGE_MAX_SIZE
+
+    get_auth_headers = RedmineClient.get_auth_headers
+
+    async def get(self, *args, **kwargs):
+        # In detail views, redmine encapsulate "foo" typed objects under a
+        # "foo" key on the JSON.
+        ret = await super().get(*args, **kwargs)
+        values = ret.values()
+        if len(values) == 1:
+            return list(values)[0]
+        else:
+            return ret
+
+    async def unpaginated_get(self, url, **kwargs):
+        """ Gets all the resources of a paginated list
+
+        The first page gives the total count, the remaining pages are then
+        fetched concurrently.
+
+        :rtype: list
+        """
+        params = dict(kwargs.pop('params', {}))
+        params['limit'] = self.PAGE_MAX_SIZE
+
+        resp = await self.get(url, params=params, **kwargs)
+
+        keys_candidates = (
+            set(resp.keys()) - set(['total_count', 'offset', 'limit']))
+        assert len(keys_candidates) == 1
+        res_list_key = list(keys_candidates)[0]
+
+        if 'offset' not in resp:
+            raise ValueError('HTTP response data is not paginated')
+
+        page_size = resp['limit'] or self.PAGE_MAX_SIZE
+        offsets = range(
+            resp['offset'] + page_size, resp['total_count'], page_size)
+        pages = await asyncio.gather(*(
+            self.get(url, params=dict(params, offset=offset), **kwargs)
+            for offset in offsets))
+
+        return list(chain(
+            resp[res_list_key], *(page[res_list_key] for page in pages)))
+
+
+class AsyncGitlabClient(AsyncAPIClient):
+    """ asyncio counterpart of GitlabClient
+    """
+    MAX_PER_PAGE = GitlabClient.MAX_PER_PAGE
+
+    get_auth_headers = GitlabClient.get_auth_headers
+
+    async def get(self, url, **kwargs):
+        """ GET a resource, iterating over pagination for lists
+
+        As GitlabClient.get(): all the pages are fetched concurrently when
+        ``X-Total-Pages`` is given, otherwise the ``Link`` or
+        ``X-Next-Page`` headers are followed.
+        """
+        params = dict(kwargs.pop('params', {}))
+        params['page'] = 1
+        params['per_page'] = self.MAX_PER_PAGE
+
+        resp = await self._request('GET', url, params=params, **kwargs)
+        result = resp.data
+        if not isinstance(result, list):
+            return result
+
+        total_pages = resp.headers.get('X-Total-Pages')
+        if total_pages:
+            pages = await asyncio.gather(*(
+                self._req('GET', url, params=dict(params, page=page), **kwargs)
+                for page in range(2, int(total_pages) + 1)))
+            for page in pages:
+                result.extend(page)
+        else:
+            async for i in self._follow_pages(url, resp, params, kwargs):
+                result.append(i)
+        return result
+
+    async def _follow_pages(self, url, resp, params, kwargs):
+        while True:
+            next_link = resp.links.get('next')
+            next_page = resp.headers.get('X-Next-Page')
+            if next_link:
+                # the link embeds every query param, including keyset cursor
+                resp = await self._request('GET', next_link, **kwargs)
+            elif next_page:
+                resp = await self._request(
+                    'GET', url, params=dict(params, page=int(next_page)),
+                    **kwargs)
+            else:
+                return
+            for i in resp.data:
+                yield i
+
+    async def iter_keyset(self, url, **kwargs):
+        """ Iterates over a v4 listing using keyset pagination
+
+        Falls back to offset pagination on endpoints that do not support
+        keyset, as GitlabClient.iter_keyset().
+        """
+        params = dict(kwargs.pop('params', {}))
+        params.update({
+            'pagination': 'keyset',
+            'order_by': 'id',
+            'sort': 'asc',
+            'per_page': self.MAX_PER_PAGE,
+        })
+
+        try:
+            resp = await self._request('GET', url, params=params, **kwargs)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in (400, 405):
+                raise
+            # keyset pagination not available for this resource
+            for i in ('pagination', 'order_by', 'sort'):
+                del params[i]
+            params['page'] = 1
+            resp = await self._request('GET', url, params=params, **kwargs)
+
+        for i in resp.data:
+            yield i
+        async for i in self._follow_pages(url, resp, params, kwargs):
+            yield i
+
+
+class AsyncRedmineProject:
+    """ Extraction of a RedmineProject issues, users and pages, with asyncio
+
+    :param project: the RedmineProject, giving URLs, id range and store
+    :param api: an AsyncRedmineClient
+    """
+    def __init__(self, project, api):
+        self.project = project
+        self.api = api
+        self._users = {}
+
+    async def get_issue(self, issue_id):
+        issue_url = '{}/issues/{}.json?include=journals,watchers,relations,children,attachments,changesets'.format(
+            self.project.instance_url, issue_id)
+        return await self.api.get(issue_url)
+
+    async def iter_issues(self):
+        """ Iterates over detailed issues, sorted by id
+
+        Up to the project ``fetch_workers`` issues details are requested at
+        once, the next ones being requested as they are consumed.
+        """
+        project = self.project
+        params = {'status_id': '*'}
+        if project.initial_id is not None and project.max_id is not None:
+            params['issue_id'] = '><{}|{}'.format(project.initial_id, project.max_id)
+        elif project.initial_id is not None:
+            params['issue_id'] = '>={}'.format(project.initial_id)
+        elif project.max_id is not None:
+            params['issue_id'] = '<={}'.format(project.max_id)
+
+        issues = await self.api.unpaginated_get(
+            '{}/issues.json'.format(project.public_url), params=params)
+        updated_on = {
+            i['id']: i.get('updated_on') for i in issues
+            if project.in_id_range(i['id'])}
+
+        async def get_fresh_issue(issue_id):
+            if project.store is None:
+                return await self.get_issue(issue_id)
+
+            issue = project.store.get_issue(issue_id, updated_on[issue_id])
+            if issue is None:
+                issue = await self.get_issue(issue_id)
+                project.store.put_issue(project.public_url, issue)
+            return issue
+
+        issues_ids = iter(sorted(updated_on))
+        tasks = deque(
+            asyncio.ensure_future(get_fresh_issue(i))
+            for i in islice(issues_ids, max(1, project.fetch_workers)))
+        try:
+            while tasks:
+                issue = await tasks.popleft()
+                for i in islice(issues_ids, 1):
+                    tasks.append(asyncio.ensure_future(get_fresh_issue(i)))
+                yield issue
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_user(self, user_id):
+        """ Get a single user, through the snapshot store if any
+
+        :return: the user, None if it does not exist
+        """
+        store = self.project.store
+        if store is not None:
+            user = store.get_user(user_id)
+            if user is not None:
+                return user
+        try:
+            user = await self.api.get('{}/users/{}.json'.format(
+                self.project.instance_url, user_id))
+        except aiohttp.ClientResponseError as e:
+            if e.status != 404:
+                raise
+            return None
+        if store is not None:
+            store.put_user(user)
+        return user
+
+    async def get_users_index(self, user_ids):
+        """ Returns an index (by id) of the given users, fetched once each
+
+        :rtype: dict
+        """
+        user_ids = set(user_ids) - RedmineUsersIndex.IGNORED_IDS
+        for i in user_ids:
+            if i not in self._users:
+                self._users[i] = asyncio.ensure_future(self.get_user(i))
+        users = await asyncio.gather(*(self._users[i] for i in user_ids))
+        return {i['id']: i for i in users if i is not None}
+
+    async def get_all_pages(self):
+        return await self.api.get(
+            '{}/wiki/index.json'.format(self.project.public_url))
+
+    async def get_page(self, title, version):
+        return await self.api.get(
+            '{}/wiki/{}/{}.json'.format(self.project.public_url, title, version))
+
+
+class AsyncGitlabProject:
+    """ Creation of issues on a GitlabProject, with asyncio
+
+    :param project: the GitlabProject, giving URLs and the labels cache
+    :param api: an AsyncGitlabClient
+    :param note_workers: max number of notes of an issue posted at once
+    :param upload_workers: max number of attachments uploaded at once, all
+        issues together
+    """
+    def __init__(self, project, api, note_workers=1, upload_workers=1):
+        self.project = project
+        self.api = api
+        self.note_workers = note_workers
+        self._uploads_semaphore = asyncio.Semaphore(upload_workers)
+        self._labels_lock = asyncio.Lock()
+        self._users = {}
+
+    async def get_user(self, username):
+        """ Looks a single user up by username
+
+        :return: the user, None if it does not exist
+        """
+        users = await self.api.get(
+            '{}/users'.format(self.project.get_instance().url_v4),
+            params={'username': username})
+        for i in users:
+            # usernames are case insensitive on gitlab
+            if i['username'].lower() == username.lower():
+                return i
+        return None
+
+    async def get_users_index(self, usernames):
+        """ Returns an index (by login) of the given users, fetched once each
+
+        :rtype: dict
+        """
+        usernames = set(usernames)
+        for i in usernames:
+            if i not in self._users:
+                self._users[i] = asyncio.ensure_future(self.get_user(i))
+        users = await asyncio.gather(*(self._users[i] for i in usernames))
+        return {name: user for name, user in zip(usernames, users)
+                if user is not None}
+
+    async def upload(self, u):
+        """ Uploads a redmine attachment to the project
+
+        :return: the markdown referencing the upload
+        """
+        uploads_url = '{}/uploads'.format(self.project.api_url)
+        async with self._uploads_semaphore:
+            with tempfile.NamedTemporaryFile() as f:
+                with Transfer('downloaded {}'.format(u['filename'])) as t:
+                    t.size = await self.api.download(u['content_url'], f)
+                f.flush()
+
+                # aiohttp closes the files it sends, each attempt gets its own
+                def form(filename):
+                    def build():
+                        data = aiohttp.FormData()
+                        data.add_field(
+                            'file', open(f.name, 'rb'), filename=filename,
+                            content_type=u['content_type'])
+                        return data
+                    return build
+
+                log.info('\tuploading {} ({} / {})'.format(
+                    u['filename'], u['content_url'], u['content_type']))
+                try:
+                    upload = await self.api.post(
+                        uploads_url, data=form(u['filename']))
+                except aiohttp.ClientResponseError:
+                    # gitlab might fail on filenames with special chars,
+                    # retry with an ascii only filename
+                    upload = await self.api.post(
+                        uploads_url,
+                        data=form(self.project.remove_non_ascii(u['filename'])))
+        return upload['markdown']
+
+    async def find_issue(self, data):
+        issues = await self.api.get(
+            '{}/issues'.format(self.project.api_url_v4),
+            params={'search': data['title'], 'in': 'title'})
+        found = [i for i in issues
+                 if i['title'] == data['title']
+                 and _same_date(i.get('created_at'), data.get('created_at'))]
+        return max(found, key=lambda i: i['id']) if found else None
+
+    async def find_note(self, notes_url, data):
+        for note in await self.api.get(notes_url):
+            if (note['body'] == data['body']
+                    and _same_date(note.get('created_at'), data.get('created_at'))):
+                return note
+        return None
+
+    async def create_issue(self, data, meta, on_created=None):
+        """ High-level issue creation, as GitlabProject.create_issue()
+        """
+        markdowns = await asyncio.gather(
+            *(self.upload(u) for u in meta['uploads']))
+        if markdowns:
+            data['description'] = "{}\n* Uploads:\n  * {}".format(
+                data['description'], "\n  * ".join(
+                    '{} {}'.format(m, u['description'])
+                    for m, u in zip(markdowns, meta['uploads'])))
+
+        credentials = {
+            'sudo': meta.get('sudo_user', None),
+            'api_key': meta.get('fake_sudo', None),
+        }
+
+        issues_url = '{}/issues'.format(self.project.api_url)
+        issue = await self.api.post(
+            issues_url, data=data,
+            recover=lambda: self.find_issue(data), **credentials)
+        if on_created is not None:
+            on_created(issue)
+        issue_url = '{}/{}'.format(issues_url, issue['id'])
+
+        # notes hold their creation date, their posting order does not matter
+        issue_notes_url = '{}/notes'.format(issue_url)
+        semaphore = asyncio.Semaphore(self.note_workers)
+
+        async def post_note(note_data, note_meta):
+            async with semaphore:
+                return await self.api.post(
+                    issue_notes_url, data=note_data,
+                    recover=lambda: self.find_note(issue_notes_url, note_data),
+                    sudo=note_meta.get('sudo_user', None),
+                    api_key=note_meta.get('fake_sudo', None))
+
+        await asyncio.gather(*(post_note(*note) for note in meta['notes']))
+
+        if meta['must_close']:
+            await self.api.put(
+                issue_url, {'state_event': 'close'},
+                api_key=credentials['api_key'])
+
+        return issue
+
+    async def delete_issue(self, iid):
+        await self.api.delete('{}/issues/{}'.format(self.project.api_url, iid))
+
+    async def create_label(self, data):
+        """ Creates a label if it does not exist, as GitlabProject.create_label()
+        """
+        labels_url = '{}/labels'.format(self.project.api_url)
+        cache = self.project._cache_labels
+
+        async with self._labels_lock:
+            label = cache.get(data['name'], None)
+            if label:
+                return label
+
+            if not data.get('color', None):
+                data['color'] = "#428BCA"
+            if data['name'] in ('In progress', 'En cours'):
+                data['color'] = "#5CB85C"
+            elif data['name'] in ('Testing', 'En test'):
+                data['color'] = "#9A90C5"
+
+            try:
+                label = await self.api.post(
+                    labels_url, data=data, idempotent=True)
+                cache[label['name']] = label
+            except aiohttp.ClientResponseError as e:
+                if e.status != 409:
+                    raise
+                cache[data['name']] = data
+            return label
+
+    async def create_watcher(self, data, meta, iid):
+        watchers_url = '{}/issues/{}/award_emoji'.format(
+            self.project.api_url_v4, iid)
+        return await self.api.post(
+            watchers_url, data=data, api_key=meta.get('fake_sudo', None))
+
+    async def migrate_issue(self, data, meta, on_created=None):
+        """ Creates an issue along with its labels and watchers, as
+        commands.migrate_issue()
+
+        :return: the created issue
+        """
+        for label in chain(meta.get('labels', []), meta.get('tags', [])):
+            await self.create_label(label)
+
+        created = await self.create_issue(data, meta, on_created)
+
+        for watcher in meta.get('watchers', []):
+            await self.create_watcher(
+                watcher.get('data', {}), watcher, created['iid'])
+
+        log.info('#{iid} {title}'.format(**created))
+        return created
@@ -0,0 +1,455 @@
+""" Local on-disk caches, to avoid repeating work between invocations
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import zlib
+
+from .multipart import Transfer
+
+log = logging.getLogger(__name__)
+
+
+def _dump(obj):
+    return zlib.compress(json.dumps(obj).encode('utf-8'))
+
+
+def _load(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class IdCache:
+    """ Small JSON mapping persisted on disk
+
+    Used to remember ids resolved through the API (projects, groups...), so
+    that repeated invocations can skip the lookups.
+    """
+    FILENAME = 'ids.json'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as stream:
+                self._data = json.load(stream)
+        except (IOError, ValueError):
+            self._data = {}
+
+    @classmethod
+    def in_dir(cls, cache_dir):
+        """ Returns the cache stored in ``cache_dir``, None if not set
+        """
+        if cache_dir is None:
+            return None
+        os.makedirs(cache_dir, exist_ok=True)
+        return cls(os.path.join(cache_dir, cls.FILENAME))
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as stream:
+                json.dump(self._data, stream, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        log.debug('Cached {} = {}'.format(key, value))
+
+
+class SQLiteDatabase:
+    """ SQLite database shared by threads, created with ``SCHEMA``
+    """
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(self.SCHEMA)
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _write(self, sql, *params):
+        with self._lock, self._db:
+            self._db.execute(sql, params)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SnapshotStore(SQLiteDatabase):
+    """ Local snapshot of the data extracted from redmine
+
+    Kept in a SQLite database, each object being stored as compressed JSON.
+    Issues are stored along with their ``updated_on`` date, so that an issue
+    is only fetched again when it changed on redmine.
+    """
+    FILENAME = 'redmine.sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS issues (
+            id INTEGER PRIMARY KEY,
+            project TEXT NOT NULL,
+            updated_on TEXT,
+            data BLOB NOT NULL);
+        CREATE INDEX IF NOT EXISTS issues_project ON issues (project);
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS versions (
+            project TEXT PRIMARY KEY,
+            data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS migrated_issues (
+            target TEXT NOT NULL,
+            redmine_id INTEGER NOT NULL,
+            gitlab_iid INTEGER,
+            partial INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (target, redmine_id));
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT);
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        with self._lock, self._db:
+            columns = [i[1] for i in self._db.execute(
+                'PRAGMA table_info(migrated_issues)')]
+            if 'partial' not in columns:
+                # store created before partial migrations were recorded
+                self._db.execute(
+                    'ALTER TABLE migrated_issues '
+                    'ADD COLUMN partial INTEGER NOT NULL DEFAULT 0')
+
+    @classmethod
+    def in_dir(cls, cache_dir):
+        """ Returns the store kept in ``cache_dir``, None if not set
+        """
+        if cache_dir is None:
+            return None
+        os.makedirs(cache_dir, exist_ok=True)
+        return cls(os.path.join(cache_dir, cls.FILENAME))
+
+    def get_issue(self, issue_id, updated_on=None):
+        """ Returns a stored issue
+
+        :param updated_on: if set, only return the issue if it is as fresh
+        :return: the issue, None if not stored (or outdated)
+        """
+        rows = self._query(
+            'SELECT updated_on, data FROM issues WHERE id = ?', issue_id)
+        if not rows:
+            return None
+        stored_updated_on, data = rows[0]
+        if updated_on is not None and stored_updated_on != updated_on:
+            return None
+        return _load(data)
+
+    def get_issues(self, project):
+        """ Iterates over all the stored issues of a project, sorted by id
+
+        Issues are loaded one at a time, to keep memory usage low.
+        """
+        for issue_id in self.get_issues_ids(project):
+            yield self.get_issue(issue_id)
+
+    def get_issues_ids(self, project):
+        return [i for i, in self._query(
+            'SELECT id FROM issues WHERE project = ? ORDER BY id', project)]
+
+    def put_issue(self, project, issue):
+        self._write(
+            'INSERT OR REPLACE INTO issues (id, project, updated_on, data) '
+            'VALUES (?, ?, ?, ?)',
+            issue['id'], project, issue.get('updated_on'), _dump(issue))
+
+    def get_user(self, user_id):
+        rows = self._query('SELECT data FROM users WHERE id = ?', user_id)
+        return _load(rows[0][0]) if rows else None
+
+    def put_user(self, user):
+        self._write(
+            'INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)',
+            user['id'], _dump(user))
+
+    def get_versions(self, project):
+        rows = self._query(
+            'SELECT data FROM versions WHERE project = ?', project)
+        return _load(rows[0][0]) if rows else None
+
+    def put_versions(self, project, versions):
+        self._write(
+            'INSERT OR REPLACE INTO versions (project, data) VALUES (?, ?)',
+            project, _dump(versions))
+
+    def get_migrated_ids(self, target):
+        """ Returns the redmine ids of issues already migrated to a target
+        """
+        return set(i for i, in self._query(
+            'SELECT redmine_id FROM migrated_issues WHERE target = ?', target))
+
+    def get_partially_migrated(self, target):
+        """ Returns the issues created on a target, but not completely
+
+        Their notes, closing or watchers may be missing.
+
+        :return: dict of gitlab iids by redmine id
+        """
+        return dict(self._query(
+            'SELECT redmine_id, gitlab_iid FROM migrated_issues '
+            'WHERE target = ? AND partial', target))
+
+    def put_migrated(self, target, redmine_id, gitlab_iid, partial=False):
+        """ Records an issue as migrated
+
+        :param partial: True if the issue is created, but its migration is
+            not complete yet
+        """
+        self._write(
+            'INSERT OR REPLACE INTO migrated_issues '
+            '(target, redmine_id, gitlab_iid, partial) VALUES (?, ?, ?, ?)',
+            target, redmine_id, gitlab_iid, int(partial))
+
+    def get_meta(self, key, default=None):
+        rows = self._query('SELECT value FROM meta WHERE key = ?', key)
+        return rows[0][0] if rows else default
+
+    def set_meta(self, key, value):
+        self._write(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            key, value)
+
+
+class AttachmentCache:
+    """ Local content-addressed cache of redmine attachments
+
+    Downloaded files are stored once per content, under their sha256. An
+    index maps redmine attachments (id plus digest, so that a replaced file
+    is downloaded again) to their content, and, per gitlab project, content
+    to the markdown of its upload: identical files are uploaded once and
+    referenced many times.
+    """
+    DIRNAME = 'attachments'
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.blobs_path = os.path.join(path, 'blobs')
+        os.makedirs(self.blobs_path, exist_ok=True)
+        self._index = AttachmentIndex(os.path.join(path, AttachmentIndex.FILENAME))
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @classmethod
+    def in_dir(cls, cache_dir):
+        """ Returns the cache kept in ``cache_dir``, None if not set
+        """
+        if cache_dir is None:
+            return None
+        return cls(os.path.join(cache_dir, cls.DIRNAME))
+
+    def lock(self, key):
+        """ Returns a lock dedicated to ``key``, to serialize work on it
+        """
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def blob_path(self, sha):
+        return os.path.join(self.blobs_path, sha)
+
+    def get_blob(self, attachment_id, digest):
+        """ Returns the sha256 of a cached attachment, None if not cached
+        """
+        sha = self._index.get_file(attachment_id, digest)
+        if sha is not None and os.path.exists(self.blob_path(sha)):
+            return sha
+        return None
+
+    def fetch(self, attachment_id, digest, open_stream):
+        """ Returns the sha256 of an attachment, downloading it if needed
+
+        :param open_stream: callable returning a file-like object reading the
+            attachment, only called if the attachment is not cached
+        """
+        with self.lock('file:{}-{}'.format(attachment_id, digest or '')):
+            sha = self.get_blob(attachment_id, digest)
+            if sha is not None:
+                return sha
+
+            h = hashlib.sha256()
+            fd, tmp_path = tempfile.mkstemp(dir=self.blobs_path)
+            try:
+                with os.fdopen(fd, 'wb') as f, Transfer(
+                        'downloaded attachment {}'.format(attachment_id)) as t:
+                    stream = open_stream()
+                    try:
+                        for chunk in iter(
+                                lambda: stream.read(self.CHUNK_SIZE), b''):
+                            h.update(chunk)
+                            f.write(chunk)
+                            t.size += len(chunk)
+                    finally:
+                        stream.close()
+                sha = h.hexdigest()
+                os.replace(tmp_path, self.blob_path(sha))
+            except:
+                os.unlink(tmp_path)
+                raise
+
+            self._index.put_file(attachment_id, digest, sha)
+            return sha
+
+    def get_upload(self, project, sha):
+        """ Returns the markdown of a content uploaded to project, if any
+        """
+        return self._index.get_upload(project, sha)
+
+    def set_upload(self, project, sha, markdown):
+        self._index.put_upload(project, sha, markdown)
+
+
+class AttachmentIndex(SQLiteDatabase):
+    """ Index of an AttachmentCache
+
+    Maps redmine attachments to the sha256 of their content, and contents to
+    their upload markdown, per gitlab project.
+    """
+    FILENAME = 'index.sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            attachment_id INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            sha TEXT NOT NULL,
+            PRIMARY KEY (attachment_id, digest));
+        CREATE TABLE IF NOT EXISTS uploads (
+            project TEXT NOT NULL,
+            sha TEXT NOT NULL,
+            markdown TEXT NOT NULL,
+            PRIMARY KEY (project, sha));
+    """
+
+    def get_file(self, attachment_id, digest):
+        rows = self._query(
+            'SELECT sha FROM files WHERE attachment_id = ? AND digest = ?',
+            attachment_id, digest or '')
+        return rows[0][0] if rows else None
+
+    def put_file(self, attachment_id, digest, sha):
+        self._write(
+            'INSERT OR REPLACE INTO files (attachment_id, digest, sha) '
+            'VALUES (?, ?, ?)',
+            attachment_id, digest or '', sha)
+
+    def get_upload(self, project, sha):
+        rows = self._query(
+            'SELECT markdown FROM uploads WHERE project = ? AND sha = ?',
+            project, sha)
+        return rows[0][0] if rows else None
+
+    def put_upload(self, project, sha, markdown):
+        self._write(
+            'INSERT OR REPLACE INTO uploads (project, sha, markdown) '
+            'VALUES (?, ?, ?)',
+            project, sha, markdown)
+
+
+class SpillList:
+    """ Append-only list that spills its items to disk above a memory limit
+
+    Items are kept in memory until their (JSON encoded) size reaches
+    ``max_bytes``, then all of them are moved to a temporary SQLite database,
+    as compressed JSON, and so are the next ones. Reading them back is done
+    one item at a time.
+
+    Not thread-safe.
+    """
+    # SQLite page cache size, in KiB
+    CACHE_SIZE = 256
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = []
+        self._bytes = 0
+        self._db = None
+        self._len = 0
+
+    @property
+    def spilled(self):
+        return self._db is not None
+
+    def _spill(self):
+        log.debug('Spilling {} items ({} bytes) to disk'.format(
+            len(self._items), self._bytes))
+        # an empty path is a private temporary database, deleted on close
+        self._db = sqlite3.connect('', check_same_thread=False)
+        self._db.execute('PRAGMA cache_size = -{}'.format(self.CACHE_SIZE))
+        self._db.execute(
+            'CREATE TABLE items (id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        items, self._items = self._items, []
+        for i in items:
+            self._write(i)
+
+    def _write(self, item):
+        with self._db:
+            self._db.execute(
+                'INSERT INTO items (data) VALUES (?)', (_dump(item),))
+
+    def append(self, item):
+        if self.spilled:
+            self._write(item)
+        else:
+            self._items.append(item)
+            self._bytes += len(json.dumps(item))
+            if self._bytes > self.max_bytes:
+                self._spill()
+        self._len += 1
+
+    def extend(self, items):
+        for i in items:
+            self.append(i)
+
+    def close(self):
+        if self.spilled:
+            self._db.close()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        if not self.spilled:
+            yield from list(self._items)
+            return
+
+        last_id = 0
+        while True:
+            # fetch by batches, without keeping a cursor open
+            rows = self._db.execute(
+                'SELECT id, data FROM items WHERE id > ? ORDER BY id LIMIT 100',
+                (last_id,)).fetchall()
+            if not rows:
+                return
+            for last_id, data in rows:
+                yield _load(data)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('SpillList index out of range')
+
+        if not self.spilled:
+            return self._items[index]
+        data, = self._db.execute(
+            'SELECT data FROM items WHERE id = ?', (index + 1,)).fetchone()
+        return _load(data)
@@ -1,5 +1,6 @@
 #!/bin/env python3
 import argparse
+import asyncio
 import logging
 import re
 import sys
@@ -7,10 +8,13 @@ from calendar import monthrange
 from datetime import date
 from datetime import timedelta
 
-from redmine_gitlab_migrator.redmine import RedmineProject, RedmineClient
+from redmine_gitlab_migrator import APIClient, Timeouts
+from redmine_gitlab_migrator.cache import AttachmentCache, IdCache, SnapshotStore
+from redmine_gitlab_migrator.redmine import RedmineProject, RedmineClient, issue_user_ids
 from redmine_gitlab_migrator.gitlab import GitlabProject, GitlabClient
-from redmine_gitlab_migrator.converters import convert_issue, convert_version, load_user_dict, load_user_keys
+from redmine_gitlab_migrator.converters import convert_issue, convert_version, load_user_dict, load_user_keys, redmine_username_to_gitlab_username
 from redmine_gitlab_migrator.logger import setup_module_logging
+from redmine_gitlab_migrator.pipeline import imap, imap_fair
 from redmine_gitlab_migrator.wiki import TextileConverter, WikiPageConverter
 from redmine_gitlab_migrator import sql
 from redmine_gitlab_migrator.db import init_db, project_labels
@@ -67,6 +71,29 @@ def parse_args():
             '--redmine-key',
             required=True,
             help="Redmine administrator API key")
+        i.add_argument(
+            '--fetch-workers',
+            required=False, type=int, default=RedmineProject.FETCH_WORKERS,
+            help="number of redmine issues fetched concurrently, default {}".format(
+                RedmineProject.FETCH_WORKERS))
+
+    # only the commands reading redmine through the snapshot store
+    for i in (parser_issues, parser_roadmap, parser_redirect):
+        i.add_argument(
+            '--offline',
+            required=False, action='store_true', default=False,
+            help="read redmine data from the --cache-dir snapshot only, without requesting redmine")
+
+    for i in (parser_issues, parser_redirect):
+        i.add_argument(
+            '--delta',
+            required=False, action='store_true', default=False,
+            help="only fetch redmine issues updated since the last extraction kept in --cache-dir")
+
+    parser_redirect.add_argument(
+        '--memory-limit',
+        required=False, type=int,
+        help="max size (MB) of redmine issues kept in memory, above it they spill to disk")
 
     for i in (parser_issues, parser_roadmap, parser_labels, parser_iid, parser_redirect):
         i.add_argument('gitlab_project_url')
@@ -91,6 +118,61 @@ def parse_args():
             required=False, action='store_false', default=True,
             help="disable SSL certificate verification")
 
+        i.add_argument(
+            '--cache-dir',
+            required=False,
+            help="directory where to keep data between invocations (resolved ids, redmine snapshot...)")
+
+        i.add_argument(
+            '--pool-size',
+            required=False, type=int, default=APIClient.POOL_SIZE,
+            help="max number of pooled HTTP connections per host, default {}".format(
+                APIClient.POOL_SIZE))
+
+        i.add_argument(
+            '--page-workers',
+            required=False, type=int, default=APIClient.PAGE_WORKERS,
+            help="max number of listing pages fetched concurrently, default {}".format(
+                APIClient.PAGE_WORKERS))
+
+        i.add_argument(
+            '--no-keep-alive', dest='keep_alive',
+            required=False, action='store_false', default=True,
+            help="close HTTP connections after each request")
+
+        i.add_argument(
+            '--adaptive-concurrency', dest='adaptive',
+            required=False, action='store_true', default=False,
+            help="adjust the number of concurrent requests per host (up to --pool-size) to the server health")
+
+        i.add_argument(
+            '--timeout', type=parse_timeouts,
+            required=False, default=APIClient.TIMEOUTS,
+            help="HTTP timeouts in seconds: CONNECT,READ[,TOTAL], default {},{}".format(
+                APIClient.TIMEOUTS.connect, APIClient.TIMEOUTS.read))
+
+        i.add_argument(
+            '--endpoint-timeout', type=parse_endpoint_timeout,
+            dest='endpoint_timeouts', action='append', default=[],
+            required=False,
+            help="HTTP timeouts of the URLs matching a regex: REGEX=CONNECT,READ[,TOTAL], can be repeated")
+
+        i.add_argument(
+            '--hedge',
+            required=False, action='store_true', default=False,
+            help="send a GET again when its response is slower than most of its endpoint ones")
+
+        i.add_argument(
+            '--memo-ttl', type=float,
+            required=False,
+            help="seconds during which a GET response is reused for identical GETs, default none (only concurrent ones share a request)")
+
+        i.add_argument(
+            '--retries',
+            required=False, type=int, default=APIClient.RETRIES,
+            help="max number of times a failed HTTP request is sent again, default {}".format(
+                APIClient.RETRIES))
+
     parser_issues.add_argument(
         '--closed-states',
         required=False,
@@ -136,12 +218,50 @@ def parse_args():
         required=False,
         help="Max issue ID, to skip some issues")
 
+    parser_issues.add_argument(
+        '--convert-workers',
+        required=False, type=int, default=2,
+        help="number of issues converted concurrently, default 2")
+
+    parser_issues.add_argument(
+        '--create-workers',
+        required=False, type=int, default=1,
+        help="number of issues created concurrently on gitlab, not used with --keep-id, default 1")
+
+    parser_issues.add_argument(
+        '--note-workers',
+        required=False, type=int, default=GitlabProject.NOTE_WORKERS,
+        help="number of notes of an issue posted concurrently, default {}".format(
+            GitlabProject.NOTE_WORKERS))
+
+    parser_issues.add_argument(
+        '--upload-workers',
+        required=False, type=int, default=GitlabProject.UPLOAD_WORKERS,
+        help="number of attachments uploaded concurrently, default {}".format(
+            GitlabProject.UPLOAD_WORKERS))
+
+    parser_issues.add_argument(
+        '--user-rate-limit', type=float,
+        required=False,
+        help="max number of requests per second sent with each user own key (--user-keys), default no limit")
+
     parser_issues.add_argument(
         '--no-sudo', dest='sudo',
         action='store_false',
         default=True,
         help="do not use sudo, use if user is not admin (e.g. gitlab.com)")
 
+    for i in (parser_issues, parser_pages):
+        i.add_argument(
+            '--async', dest='use_async',
+            required=False, action='store_true', default=False,
+            help="send requests from a single asyncio event loop instead of worker threads, requires aiohttp")
+
+        i.add_argument(
+            '--max-in-flight',
+            required=False, type=int, default=100,
+            help="with --async, max number of requests in flight, default 100")
+
     parser_pages.add_argument(
         '--gitlab-wiki',
         required=True,
@@ -156,6 +276,88 @@ def parse_args():
     return parser.parse_args()
 
 
+def parse_timeouts(value):
+    """ Parses CONNECT,READ[,TOTAL] timeouts, empty meaning no timeout
+    """
+    try:
+        values = [float(i) if i else None for i in value.split(',')]
+    except ValueError:
+        values = []
+    if len(values) not in (2, 3):
+        raise argparse.ArgumentTypeError(
+            'expected CONNECT,READ[,TOTAL] timeouts, got {}'.format(value))
+    return Timeouts(*values + [None] * (3 - len(values)))
+
+
+def parse_endpoint_timeout(value):
+    """ Parses REGEX=CONNECT,READ[,TOTAL] timeouts
+    """
+    pattern, sep, timeouts = value.rpartition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            'expected REGEX=CONNECT,READ[,TOTAL], got {}'.format(value))
+    return pattern, parse_timeouts(timeouts)
+
+
+def client_kwargs(args):
+    """ Returns the HTTP clients options set on command line
+    """
+    return {
+        'pool_size': args.pool_size,
+        'keep_alive': args.keep_alive,
+        'page_workers': args.page_workers,
+        'retries': args.retries,
+        'adaptive': args.adaptive,
+        'timeouts': args.timeout,
+        'endpoint_timeouts': args.endpoint_timeouts,
+        'hedge': args.hedge,
+        'memo_ttl': args.memo_ttl,
+    }
+
+
+def redmine_project_kwargs(args):
+    """ Returns the redmine project options set on command line
+    """
+    offline = getattr(args, 'offline', False)
+    delta = getattr(args, 'delta', False)
+    memory_limit = getattr(args, 'memory_limit', None)
+    if (offline or delta) and args.cache_dir is None:
+        raise CommandError('--offline and --delta require --cache-dir')
+
+    return {
+        'fetch_workers': args.fetch_workers,
+        'store': SnapshotStore.in_dir(args.cache_dir),
+        'offline': offline,
+        'delta': delta,
+        'initial_id': int(args.initial_id) if getattr(args, 'initial_id', None) else None,
+        'max_id': int(args.max_id) if getattr(args, 'max_id', None) else None,
+        'memory_limit': memory_limit * 1024 * 1024 if memory_limit else None,
+    }
+
+
+def async_client_kwargs(args):
+    """ Returns the asyncio HTTP clients options set on command line
+    """
+    return {
+        'max_in_flight': args.max_in_flight,
+        'retries': args.retries,
+        'timeouts': args.timeout,
+        'endpoint_timeouts': args.endpoint_timeouts,
+    }
+
+
+def run_async(coro_func, args):
+    """ Runs an async command, checking it can be
+    """
+    try:
+        from redmine_gitlab_migrator import aio
+    except ImportError:
+        raise CommandError('--async requires aiohttp (pip install aiohttp)')
+    if getattr(args, 'offline', False) or getattr(args, 'delta', False):
+        raise CommandError('--offline and --delta are not supported with --async')
+    return asyncio.run(coro_func(aio, args))
+
+
 def check(func, message, redmine_project, gitlab_project):
     log.info('{}...'.format(message))
     ret = func(redmine_project, gitlab_project)
@@ -193,8 +395,12 @@ def check_origin_milestone(redmine_project, gitlab_project):
     return len(redmine_project.get_versions()) > 0
 
 def perform_migrate_pages(args):
-    redmine = RedmineClient(args.redmine_key, args.no_verify)
-    redmine_project = RedmineProject(args.redmine_project_url, redmine)
+    if args.use_async:
+        return run_async(async_perform_migrate_pages, args)
+
+    redmine = RedmineClient(args.redmine_key, args.no_verify, **client_kwargs(args))
+    redmine_project = RedmineProject(
+        args.redmine_project_url, redmine, **redmine_project_kwargs(args))
 
     # Get copy of GitLab wiki repository
     wiki = WikiPageConverter(args.gitlab_wiki)
@@ -217,9 +423,44 @@ def perform_migrate_pages(args):
     for page in pages:
         wiki.convert(page)
 
-def perform_migrate_issues(args):
-    init_db()
 
+async def async_perform_migrate_pages(aio, args):
+    redmine_project = RedmineProject(
+        args.redmine_project_url,
+        RedmineClient(args.redmine_key, args.no_verify, **client_kwargs(args)),
+        **redmine_project_kwargs(args))
+    wiki = WikiPageConverter(args.gitlab_wiki)
+
+    async with aio.AsyncRedmineClient(
+            args.redmine_key, args.no_verify, **async_client_kwargs(args)) as redmine:
+        project = aio.AsyncRedmineProject(redmine_project, redmine)
+
+        async def get_page(title, version):
+            try:
+                return await project.get_page(title, version)
+            except Exception:
+                log.error("Error when retrieving " + title + ", version " + str(version))
+
+        # all versions of all pages are fetched at once
+        fetches = []
+        for page in await project.get_all_pages():
+            print("Collecting " + page["title"])
+            start_version = page["version"] if args.no_history else 1
+            for version in range(start_version, page["version"]+1):
+                fetches.append(get_page(page["title"], version))
+        pages = [i for i in await asyncio.gather(*fetches) if i is not None]
+
+    # sort everything by date and convert
+    pages.sort(key=lambda page: page["updated_on"])
+
+    for page in pages:
+        wiki.convert(page)
+
+def load_issues_options(args):
+    """ Loads the issues conversion options set on command line
+
+    :return: closed states and custom fields lists
+    """
     closed_states = []
     if (args.closed_states):
         closed_states = args.closed_states.split(',')
@@ -234,100 +475,397 @@ def perform_migrate_issues(args):
     if (args.user_keys is not None):
         load_user_keys(args.user_keys)
 
-    redmine = RedmineClient(args.redmine_key, args.no_verify)
-    gitlab = GitlabClient(args.gitlab_key, args.no_verify)
+    return closed_states, custom_fields
+
+
+def warn_partially_migrated(store, target):
+    """ Reports the issues a previous run created but did not complete
+    """
+    partial = store.get_partially_migrated(target)
+    if partial:
+        log.warning(
+            '{} issues were not completely migrated by a previous run (notes, '
+            'closing or watchers may be missing), gitlab iids: {}'.format(
+                len(partial), ', '.join(str(i) for i in sorted(partial.values()))))
+
+
+def not_migrated(issues, migrated_ids, redmine_project):
+    """ Filters out the issues already migrated
+
+    Migrated issues are never updated on gitlab: those updated on redmine
+    since the previous extraction (see --delta) are reported.
+    """
+    for issue in issues:
+        if issue['id'] not in migrated_ids:
+            yield issue
+        elif issue['id'] in (redmine_project.updated_ids or ()):
+            log.warning(
+                'redmine issue #{} was updated since the previous extraction, '
+                'but is already migrated: the changes are not applied on gitlab'.format(
+                    issue['id']))
+
+
+def perform_migrate_issues(args):
+    if args.use_async:
+        return run_async(async_perform_migrate_issues, args)
+
+    if args.delta and args.keep_id:
+        raise CommandError(
+            '--delta cannot be used with --keep-id, which creates all issues again')
 
-    redmine_project = RedmineProject(args.redmine_project_url, redmine)
-    gitlab_project = GitlabProject(args.gitlab_project_url, gitlab)
+    init_db()
+    closed_states, custom_fields = load_issues_options(args)
+
+    redmine = RedmineClient(args.redmine_key, args.no_verify, **client_kwargs(args))
+    gitlab = GitlabClient(
+        args.gitlab_key, args.no_verify, identity_rate=args.user_rate_limit,
+        **client_kwargs(args))
+
+    redmine_project = RedmineProject(
+        args.redmine_project_url, redmine, **redmine_project_kwargs(args))
+    gitlab_project = GitlabProject(
+        args.gitlab_project_url, gitlab,
+        id_cache=IdCache.in_dir(args.cache_dir),
+        note_workers=args.note_workers,
+        upload_workers=args.upload_workers,
+        attachment_cache=AttachmentCache.in_dir(args.cache_dir))
 
     gitlab_instance = gitlab_project.get_instance()
 
+    # users are resolved as issues are converted, so that the conversion
+    # does not have to wait for the whole extraction
+    redmine_users_index = redmine_project.get_lazy_users_index()
+
     if (args.project_members_only):
         gitlab_users_index = gitlab_project.get_members_index()
     else:
-        gitlab_users_index = gitlab_instance.get_users_index()
-
-    redmine_users_index = redmine_project.get_users_index()
+        # only lookup users participating in the project, plus the fallback
+        gitlab_users_index = gitlab_instance.get_lazy_users_index()
+        gitlab_users_index.prefetch(['root'])
     milestones_index = gitlab_project.get_milestones_index()
     textile_converter = TextileConverter()
 
     log.debug('GitLab milestones are: {}'.format(', '.join(milestones_index) + ' '))
 
-    # get issues
-    log.info('Getting redmine issues')
-    issues = redmine_project.get_all_issues()
-    if args.initial_id:
-        issues = [issue for issue in issues if int(args.initial_id) <= issue['id']]
-    if args.max_id:
-        issues = [issue for issue in issues if int(args.max_id) >= issue['id']]
-
-    # convert issues
-    log.info('Converting issues')
-    issues_data = (
-        convert_issue(args.redmine_key,
-            i, redmine_users_index, gitlab_users_index, milestones_index, closed_states, custom_fields, textile_converter,
+    # Issues go through a streaming pipeline: redmine issues are fetched,
+    # converted and created on gitlab at the same time, each stage with its
+    # own workers and a bounded buffer. Order is kept along the way.
+    log.info('Migrating redmine issues')
+    issues = redmine_project.iter_issues()
+
+    # keep track of migrated issues, so that a failed run can be resumed
+    store = redmine_project.store
+    if store is not None and not args.check and not args.keep_id:
+        migrated_ids = store.get_migrated_ids(gitlab_project.public_url)
+        if migrated_ids:
+            log.info('Skipping {} issues already migrated'.format(
+                len(migrated_ids)))
+        warn_partially_migrated(store, gitlab_project.public_url)
+        issues = not_migrated(issues, migrated_ids, redmine_project)
+
+    def convert(issue):
+        if not args.project_members_only:
+            # the gitlab users of the issue are looked up concurrently,
+            # rather than one by one along the conversion
+            gitlab_users_index.prefetch(
+                redmine_username_to_gitlab_username(redmine_users_index[i]['login'])
+                for i in issue_user_ids(issue) if i in redmine_users_index)
+        data, meta, redmine_id = convert_issue(args.redmine_key,
+            issue, redmine_users_index, gitlab_users_index, milestones_index, closed_states, custom_fields, textile_converter,
             args.keep_id or args.keep_title, args.sudo)
-        for i in issues)
+        if not args.check:
+            # attachments are uploaded while the issue waits for its turn
+            meta['pending_uploads'] = gitlab_project.submit_uploads(
+                meta['uploads'])
+        return data, meta, redmine_id
+
+    issues_data = imap(convert, issues, workers=args.convert_workers)
+
+    if args.check:
+        for data, meta, redmine_id in issues_data:
+            check_issue(gitlab_project, data, meta)
+
+    elif args.keep_id:
+        # gitlab iids follow creation order: a single, strictly ordered lane
+        last_iid = int(args.initial_id or 1) - 1
+        for data, meta, redmine_id in issues_data:
+            try:
+                fake_meta = {'uploads': [], 'notes': [], 'must_close': False}
+                if args.sudo:
+                    fake_meta['sudo_user'] = meta['sudo_user']
+                while redmine_id > last_iid + 1:
+                    created = gitlab_project.create_issue({'title': 'fake'}, fake_meta)
+                    last_iid = created['iid']
+                    gitlab_project.delete_issue(created['id'])
+                    log.info('#{iid} {title}'.format(**created))
+            except:
+                log.info('create issue "{}" failed'.format('fake'))
+                raise
 
-    # create issues
-    log.info('Creating gitlab issues')
-    last_iid = int(args.initial_id or 1) - 1
-    for data, meta, redmine_id in issues_data:
-        if args.check:
-            milestone_id = data.get('milestone_id', None)
-            if milestone_id:
-                try:
-                    gitlab_project.get_milestone_by_id(milestone_id)
-                except ValueError:
-                    raise CommandError(
-                        "issue \"{}\" points to unknown milestone_id \"{}\". "
-                        "Check that you already migrated roadmaps".format(
-                            data['title'], milestone_id))
+            try:
+                created = migrate_issue(gitlab_project, data, meta)
+                last_iid = created['iid']
+            except:
+                log.info('create issue "{}" failed'.format(data['title']))
+                raise
 
-            log.info('Would create issue "{}" and {} notes.'.format(
-                data['title'],
-                len(meta['notes'])))
+    else:
+        # iids are recovered afterwards, or not kept at all, so issues can
+        # be created concurrently, in any order
+        def create(issue_data):
+            data, meta, redmine_id = issue_data
+            record = MigrationRecord(store, gitlab_project.public_url, redmine_id)
+            try:
+                migrate_issue(gitlab_project, data, meta, record.created)
+                record.done()
+            except Exception as e:
+                record.failed(data['title'], e)
+            return record
 
-            log.info('Labels %s' % meta.get('labels', []))
-            log.info('Tags %s' % meta.get('tags', []))
-            log.info('Watchers %s' % meta.get('watchers', []))
+        # issues whose author is throttled wait, while the others go
+        def throttled(issue_data):
+            return gitlab.identity_delay(issue_data[1].get('fake_sudo'))
 
-        else:
-            if args.keep_id:
+        report_migration(imap_fair(
+            create, issues_data, throttled, workers=args.create_workers))
+
+
+async def async_perform_migrate_issues(aio, args):
+    init_db()
+    closed_states, custom_fields = load_issues_options(args)
+
+    # one-off setup (ids, milestones, members) goes through the synchronous
+    # clients, issues through the asyncio ones
+    redmine_project = RedmineProject(
+        args.redmine_project_url,
+        RedmineClient(args.redmine_key, args.no_verify, **client_kwargs(args)),
+        **redmine_project_kwargs(args))
+    gitlab_project = GitlabProject(
+        args.gitlab_project_url,
+        GitlabClient(args.gitlab_key, args.no_verify, **client_kwargs(args)),
+        id_cache=IdCache.in_dir(args.cache_dir))
+
+    members_index = None
+    if (args.project_members_only):
+        members_index = gitlab_project.get_members_index()
+    milestones_index = gitlab_project.get_milestones_index()
+    textile_converter = TextileConverter()
+
+    log.debug('GitLab milestones are: {}'.format(', '.join(milestones_index) + ' '))
+
+    store = redmine_project.store
+    migrated_ids = set()
+    if store is not None and not args.check and not args.keep_id:
+        migrated_ids = store.get_migrated_ids(gitlab_project.public_url)
+        if migrated_ids:
+            log.info('Skipping {} issues already migrated'.format(
+                len(migrated_ids)))
+        warn_partially_migrated(store, gitlab_project.public_url)
+
+    async with aio.AsyncRedmineClient(
+            args.redmine_key, args.no_verify, **async_client_kwargs(args)) as redmine, \
+            aio.AsyncGitlabClient(
+            args.gitlab_key, args.no_verify, **async_client_kwargs(args)) as gitlab:
+        async_redmine_project = aio.AsyncRedmineProject(redmine_project, redmine)
+        async_gitlab_project = aio.AsyncGitlabProject(
+            gitlab_project, gitlab,
+            note_workers=args.note_workers, upload_workers=args.upload_workers)
+
+        async def convert(issue):
+            # only the users the issue refers to are looked up
+            redmine_users_index = await async_redmine_project.get_users_index(
+                issue_user_ids(issue))
+            gitlab_users_index = members_index
+            if gitlab_users_index is None:
+                gitlab_users_index = await async_gitlab_project.get_users_index(
+                    [redmine_username_to_gitlab_username(i['login'])
+                     for i in redmine_users_index.values()] + ['root'])
+            return convert_issue(args.redmine_key,
+                issue, redmine_users_index, gitlab_users_index, milestones_index, closed_states, custom_fields, textile_converter,
+                args.keep_id or args.keep_title, args.sudo)
+
+        log.info('Migrating redmine issues')
+        issues = async_redmine_project.iter_issues()
+
+        if args.check:
+            async for issue in issues:
+                data, meta, redmine_id = await convert(issue)
+                check_issue(gitlab_project, data, meta)
+
+        elif args.keep_id:
+            # gitlab iids follow creation order: issues are created one by one
+            last_iid = int(args.initial_id or 1) - 1
+            async for issue in issues:
+                data, meta, redmine_id = await convert(issue)
                 try:
                     fake_meta = {'uploads': [], 'notes': [], 'must_close': False}
                     if args.sudo:
                         fake_meta['sudo_user'] = meta['sudo_user']
                     while redmine_id > last_iid + 1:
-                        created = gitlab_project.create_issue({'title': 'fake'}, fake_meta)
+                        created = await async_gitlab_project.create_issue(
+                            {'title': 'fake'}, fake_meta)
                         last_iid = created['iid']
-                        gitlab_project.delete_issue(created['id'])
+                        await async_gitlab_project.delete_issue(created['id'])
                         log.info('#{iid} {title}'.format(**created))
                 except:
                     log.info('create issue "{}" failed'.format('fake'))
                     raise
 
+                try:
+                    created = await async_gitlab_project.migrate_issue(data, meta)
+                    last_iid = created['iid']
+                except:
+                    log.info('create issue "{}" failed'.format(data['title']))
+                    raise
+
+        else:
+            # issues are converted and created as soon as fetched, in any
+            # order, by --create-workers at a time: the next ones are not
+            # read until a slot is free, so that memory stays bounded
+            slots = asyncio.Semaphore(args.create_workers)
+            records = []
+
+            async def create(issue):
+                try:
+                    data, meta, redmine_id = await convert(issue)
+                    record = MigrationRecord(
+                        store, gitlab_project.public_url, redmine_id)
+                    try:
+                        await async_gitlab_project.migrate_issue(
+                            data, meta, record.created)
+                        record.done()
+                    except Exception as e:
+                        record.failed(data['title'], e)
+                    records.append(record)
+                finally:
+                    slots.release()
+
+            running = set()
             try:
-                # labels
-                for label in meta.get('labels', []):
-                    gitlab_project.create_label(label)
+                async for issue in issues:
+                    if issue['id'] in migrated_ids:
+                        continue
+                    await slots.acquire()
+                    # a conversion failure stops the migration, as the
+                    # threaded pipeline does
+                    for task in [i for i in running if i.done()]:
+                        running.discard(task)
+                        task.result()
+                    running.add(asyncio.ensure_future(create(issue)))
+                await asyncio.gather(*running)
+            finally:
+                for task in running:
+                    task.cancel()
+
+            report_migration(records)
+
+
+class MigrationRecord:
+    """ Outcome of an issue migration, recorded in the snapshot store if any
+
+    The issue is recorded as soon as it is created on gitlab, as partially
+    migrated until its notes, closing and watchers are done, so that it is
+    not created again by a later run whatever fails next.
+    """
+    def __init__(self, store, target, redmine_id):
+        self.store = store
+        self.target = target
+        self.redmine_id = redmine_id
+        self.gitlab_iid = None
+        self.error = None
+
+    def created(self, issue):
+        self.gitlab_iid = issue['iid']
+        if self.store is not None:
+            self.store.put_migrated(
+                self.target, self.redmine_id, self.gitlab_iid, partial=True)
+
+    def done(self):
+        if self.store is not None:
+            self.store.put_migrated(self.target, self.redmine_id, self.gitlab_iid)
+
+    def failed(self, title, error):
+        self.error = error
+        if self.gitlab_iid is None:
+            log.error('create issue "{}" failed: {}'.format(title, error))
+        else:
+            log.error('issue "{}" created as #{}, but not completely migrated: {}'.format(
+                title, self.gitlab_iid, error))
 
-                # tags
-                for tag in meta.get('tags', []):
-                    gitlab_project.create_label(tag)
 
-                # issue
-                created = gitlab_project.create_issue(data, meta)
-                last_iid = created['iid']
+def report_migration(records):
+    """ Logs the outcome of the issues migration
 
-                # watchers
-                for watcher in meta.get('watchers', []):
-                    created_watcher = gitlab_project.create_watcher(watcher.get('data', {}), watcher, created['iid'])
+    :param records: iterable of MigrationRecord
+    :raise CommandError: if some issues failed
+    """
+    done, failed, partial = [], [], []
+    for i in records:
+        if i.error is None:
+            done.append(i.redmine_id)
+        elif i.gitlab_iid is None:
+            failed.append(i.redmine_id)
+        else:
+            partial.append(i.redmine_id)
+
+    log.info('Created {} issues'.format(len(done)))
+    errors = []
+    if failed:
+        errors.append('Failed to create {} issues, redmine ids: {}'.format(
+            len(failed), ', '.join(str(i) for i in sorted(failed))))
+    if partial:
+        errors.append(
+            '{} issues were created but not completely migrated (notes, '
+            'closing or watchers may be missing), redmine ids: {}'.format(
+                len(partial), ', '.join(str(i) for i in sorted(partial))))
+    if errors:
+        raise CommandError('\n'.join(errors))
+
+
+def check_issue(gitlab_project, data, meta):
+    milestone_id = data.get('milestone_id', None)
+    if milestone_id:
+        try:
+            gitlab_project.get_milestone_by_id(milestone_id)
+        except ValueError:
+            raise CommandError(
+                "issue \"{}\" points to unknown milestone_id \"{}\". "
+                "Check that you already migrated roadmaps".format(
+                    data['title'], milestone_id))
+
+    log.info('Would create issue "{}" and {} notes.'.format(
+        data['title'],
+        len(meta['notes'])))
+
+    log.info('Labels %s' % meta.get('labels', []))
+    log.info('Tags %s' % meta.get('tags', []))
+    log.info('Watchers %s' % meta.get('watchers', []))
+
+
+def migrate_issue(gitlab_project, data, meta, on_created=None):
+    """ Creates an issue on gitlab, along with its labels and watchers
+
+    :param on_created: see GitlabProject.create_issue()
+    :return: the created issue
+    """
+    # labels
+    for label in meta.get('labels', []):
+        gitlab_project.create_label(label)
+
+    # tags
+    for tag in meta.get('tags', []):
+        gitlab_project.create_label(tag)
+
+    # issue
+    created = gitlab_project.create_issue(data, meta, on_created)
+
+    # watchers
+    for watcher in meta.get('watchers', []):
+        gitlab_project.create_watcher(watcher.get('data', {}), watcher, created['iid'])
+
+    log.info('#{iid} {title}'.format(**created))
+    return created
 
-                log.info('#{iid} {title}'.format(**created))
-            except:
-                log.info('create issue "{}" failed'.format(data['title']))
-                raise
 
 def perform_migrate_iid(args):
     """ Should occur after the issues migration
@@ -336,8 +874,10 @@ def perform_migrate_iid(args):
     # access gitlab database with
     # gitlab-rails dbconsole
 
-    gitlab = GitlabClient(args.gitlab_key, args.no_verify)
-    gitlab_project = GitlabProject(args.gitlab_project_url, gitlab)
+    gitlab = GitlabClient(args.gitlab_key, args.no_verify, **client_kwargs(args))
+    gitlab_project = GitlabProject(
+        args.gitlab_project_url, gitlab,
+        id_cache=IdCache.in_dir(args.cache_dir))
     gitlab_project_id = gitlab_project.get_id()
 
     regex_saved_iid = r'-RM-([0-9]+)-MR-(.*)'
@@ -389,11 +929,14 @@ def perform_migrate_iid(args):
 
 
 def perform_migrate_roadmap(args):
-    redmine = RedmineClient(args.redmine_key, args.no_verify)
-    gitlab = GitlabClient(args.gitlab_key, args.no_verify)
+    redmine = RedmineClient(args.redmine_key, args.no_verify, **client_kwargs(args))
+    gitlab = GitlabClient(args.gitlab_key, args.no_verify, **client_kwargs(args))
 
-    redmine_project = RedmineProject(args.redmine_project_url, redmine)
-    gitlab_project = GitlabProject(args.gitlab_project_url, gitlab)
+    redmine_project = RedmineProject(
+        args.redmine_project_url, redmine, **redmine_project_kwargs(args))
+    gitlab_project = GitlabProject(
+        args.gitlab_project_url, gitlab,
+        id_cache=IdCache.in_dir(args.cache_dir))
 
     # auto create milestones
     milestones_data = []
@@ -469,11 +1012,14 @@ def perform_migrate_roadmap(args):
 
 
 def perform_migrate_labels(args):
-    redmine = RedmineClient(args.redmine_key, args.no_verify)
-    gitlab = GitlabClient(args.gitlab_key, args.no_verify)
+    redmine = RedmineClient(args.redmine_key, args.no_verify, **client_kwargs(args))
+    gitlab = GitlabClient(args.gitlab_key, args.no_verify, **client_kwargs(args))
 
-    redmine_project = RedmineProject(args.redmine_project_url, redmine)
-    gitlab_project = GitlabProject(args.gitlab_project_url, gitlab)
+    redmine_project = RedmineProject(
+        args.redmine_project_url, redmine, **redmine_project_kwargs(args))
+    gitlab_project = GitlabProject(
+        args.gitlab_project_url, gitlab,
+        id_cache=IdCache.in_dir(args.cache_dir))
 
     pid = redmine_project.get_id()
 
@@ -502,8 +1048,9 @@ def perform_migrate_labels(args):
             log.info("Label {}".format(created['name']))
 
 def perform_redirect(args):
-    redmine = RedmineClient(args.redmine_key, args.no_verify)
-    redmine_project = RedmineProject(args.redmine_project_url, redmine)
+    redmine = RedmineClient(args.redmine_key, args.no_verify, **client_kwargs(args))
+    redmine_project = RedmineProject(
+        args.redmine_project_url, redmine, **redmine_project_kwargs(args))
 
     # get issues
     redmine_issues = redmine_project.get_all_issues()
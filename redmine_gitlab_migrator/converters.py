@@ -52,6 +52,8 @@ def convert_attachment(redmine_issue_attachment, redmine_api_key):
     :return: a dict describing the attachment
     """
     uploads = {
+        'id': redmine_issue_attachment.get('id'),
+        'digest': redmine_issue_attachment.get('digest'),
         'filename': redmine_issue_attachment['filename'],
         'description': redmine_issue_attachment.get('description'),
         'content_url': '{}?key={}'.format(redmine_issue_attachment['content_url'], redmine_api_key),
@@ -119,7 +121,7 @@ def convert_notes(redmine_issue_journals, redmine_user_index, gitlab_user_index,
     Filters out the empty notes (ex: bare status change)
     Adds metadata as comment
 
-    :param redmine_issue_journals: list of redmine "journals"
+    :param redmine_issue_journals: iterable of redmine "journals"
     :return: yielded couple ``data``, ``meta``. ``data`` is the API payload for
         an issue note and meta a dict (containing, at the moment, only a
         "sudo_user" key).
@@ -356,6 +358,8 @@ def convert_issue(redmine_api_key, redmine_issue, redmine_user_index, gitlab_use
         data['milestone_id'] = gitlab_milestones_index[milestone]['id']
 
     meta = {
+        # notes are converted along with the issue, so that their authors
+        # lookups cannot fail once the issue is created
         'notes': list(convert_notes(redmine_issue['journals'],
                           redmine_user_index, gitlab_user_index, textile_converter, sudo)),
         'must_close': closed,
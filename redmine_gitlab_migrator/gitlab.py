@@ -1,50 +1,177 @@
 import re
 import logging
+import tempfile
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib.parse import quote
+
 import requests
 from requests import HTTPError
 
 from . import APIClient, Project
-from urllib.request import urlopen
+from .multipart import MultipartFile, Transfer, copy_stream
+from .pipeline import imap
 
 from redmine_gitlab_migrator.converters import redmine_username_to_gitlab_username
 
 log = logging.getLogger(__name__)
 
+
+def _same_date(gitlab_date, date):
+    # gitlab adds milliseconds to the dates it was given
+    return date is None or (gitlab_date or '')[:19] == date[:19]
+
+
 class GitlabClient(APIClient):
     # see http://doc.gitlab.com/ce/api/#pagination
     MAX_PER_PAGE = 100
 
-    def get(self, *args, **kwargs):
-        kwargs['params'] = kwargs.get('params', {})
-        kwargs['params']['page'] = 1
-        kwargs['params']['per_page'] = self.MAX_PER_PAGE
+    def _get(self, url, **kwargs):
+        """ GET a resource, iterating over pagination for lists
 
-        result = super().get(*args, **kwargs)
-        while (len(result) > 0 and len(result) % self.MAX_PER_PAGE == 0):
-            kwargs['params']['page'] += 1
-            result.extend(super().get(*args, **kwargs))
+        Pagination is driven by the response headers: when ``X-Total-Pages``
+        is given, the remaining pages are fetched concurrently. GitLab omits
+        totals for very large collections, in that case the ``Link`` (which
+        also handles keyset pagination) or ``X-Next-Page`` headers are
+        followed one page after another.
+        """
+        params = dict(kwargs.pop('params', {}))
+        params['page'] = 1
+        params['per_page'] = self.MAX_PER_PAGE
+
+        resp = self._request('GET', url, params=params, **kwargs)
+        result = resp.json()
+        if not isinstance(result, list):
+            return result
+
+        total_pages = resp.headers.get('X-Total-Pages')
+        if total_pages:
+            pages = range(2, int(total_pages) + 1)
+            result.extend(self._get_pages(url, pages, params, kwargs))
+        else:
+            result.extend(self._follow_pages(url, resp, params, kwargs))
         return result
 
-    def get_auth_headers(self):
-        return {"PRIVATE-TOKEN": self.api_key}
+    def _get_pages(self, url, pages, params, kwargs):
+        if len(pages) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            futures = [
+                executor.submit(
+                    self._req, 'GET', url, params=dict(params, page=page),
+                    **kwargs)
+                for page in pages]
+            for future in futures:
+                yield from future.result()
+
+    def _follow_pages(self, url, resp, params, kwargs):
+        while True:
+            next_link = resp.links.get('next')
+            next_page = resp.headers.get('X-Next-Page')
+            if next_link:
+                # the link embeds every query param, including keyset cursor
+                resp = self._request('GET', next_link['url'], **kwargs)
+            elif next_page:
+                resp = self._request(
+                    'GET', url, params=dict(params, page=int(next_page)),
+                    **kwargs)
+            else:
+                return
+            yield from resp.json()
+
+    def iter_keyset(self, url, **kwargs):
+        """ Iterates over a v4 listing using keyset pagination
+
+        Keyset pagination keeps a constant cost per page whatever the depth
+        of the listing, where offset pagination gets slower with the page
+        number. Falls back to offset pagination on endpoints that do not
+        support keyset.
+
+        :return: a generator over the listed resources
+        """
+        params = dict(kwargs.pop('params', {}))
+        params.update({
+            'pagination': 'keyset',
+            'order_by': 'id',
+            'sort': 'asc',
+            'per_page': self.MAX_PER_PAGE,
+        })
+
+        try:
+            resp = self._request('GET', url, params=params, **kwargs)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code not in (400, 405):
+                raise
+            # keyset pagination not available for this resource
+            for i in ('pagination', 'order_by', 'sort'):
+                del params[i]
+            params['page'] = 1
+            resp = self._request('GET', url, params=params, **kwargs)
+
+        yield from resp.json()
+        yield from self._follow_pages(url, resp, params, kwargs)
+
+    def get_auth_headers(self, api_key, sudo=None):
+        headers = {"PRIVATE-TOKEN": api_key}
+        if sudo:
+            headers["SUDO"] = sudo
+        return headers
 
     def check_is_admin(self):
         pass
 
 
 class GitlabInstance:
-    def __init__(self, url, client):
+    def __init__(self, url, client, url_v4=None):
         self.url = url.strip('/')  # normalize URL
         self.api = client
+        if url_v4 is None:
+            url_v4 = re.sub(r'/api/v3$', '/api/v4', self.url)
+        self.url_v4 = url_v4.strip('/')
+
+    def iter_users(self):
+        """ Iterates over all the users of the instance (keyset paginated)
+        """
+        return self.api.iter_keyset('{}/users'.format(self.url_v4))
+
+    def iter_projects(self):
+        """ Iterates over all the projects of the instance (keyset paginated)
+        """
+        return self.api.iter_keyset('{}/projects'.format(self.url_v4))
 
     def get_all_users(self):
-        return self.api.get('{}/users'.format(self.url))
+        # shared with concurrent (or recent, with a memo) calls
+        return self.api.shared(
+            'users {}'.format(self.url_v4), lambda: list(self.iter_users()))
 
     def get_users_index(self):
         """ Returns dict index of users (by login)
         """
         return {i['username']: i for i in self.get_all_users()}
 
+    def get_user(self, username):
+        """ Looks a single user up by username
+
+        :return: the user, None if it does not exist
+        """
+        users = self.api.get(
+            '{}/users'.format(self.url_v4), params={'username': username})
+        for i in users:
+            # usernames are case insensitive on gitlab
+            if i['username'].lower() == username.lower():
+                return i
+        return None
+
+    def get_lazy_users_index(self):
+        """ Returns a lazy index of users (by login)
+
+        Unlike get_users_index(), only the looked up users are fetched.
+        """
+        return GitlabUsersIndex(self)
+
     def get_group_members(self, group_id):
         return self.api.get('{}/groups/{}/members'.format(self.url, group_id))
 
@@ -61,35 +188,99 @@ class GitlabInstance:
         return all((i in gitlab_user_names for i in translated))
 
 
+class GitlabUsersIndex:
+    """ Index of gitlab users by login, resolved on demand
+
+    Behaves as the dict returned by GitlabInstance.get_users_index(), but
+    fetches users one by one as they are looked up, remembering hits and
+    misses. The cost is thus bound to the number of users involved in the
+    migration rather than to the size of the instance.
+    """
+    # Number of users looked up concurrently by prefetch()
+    WORKERS = 4
+
+    def __init__(self, instance, workers=WORKERS):
+        self.instance = instance
+        self.workers = workers
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def _resolve(self, username):
+        with self._lock:
+            if username in self._users:
+                return self._users[username]
+
+        user = self.instance.get_user(username)
+
+        with self._lock:
+            self._users[username] = user
+        return user
+
+    def prefetch(self, usernames):
+        """ Concurrently resolves a set of users, ahead of their use
+        """
+        with self._lock:
+            missing = set(usernames) - set(self._users)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self._resolve, missing))
+
+    def get(self, username, default=None):
+        user = self._resolve(username)
+        return default if user is None else user
+
+    def __contains__(self, username):
+        return self._resolve(username) is not None
+
+    def __getitem__(self, username):
+        user = self._resolve(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+
+
 class GitlabProject(Project):
     REGEX_PROJECT_URL = re.compile(
         r'^(?P<base_url>https?://[^/]+/)(?P<namespace>[\w_/-]+)/(?P<project_name>[\w_-]+)$')
 
-    def __init__(self, *args, **kwargs):
+    # Number of notes of an issue posted concurrently
+    NOTE_WORKERS = 1
+
+    # Number of attachments uploaded concurrently, all issues together
+    UPLOAD_WORKERS = 1
+    # Attachments bigger than this (in bytes) are spooled on disk rather
+    # than in memory, while transferred
+    SPOOL_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, *args, id_cache=None, note_workers=NOTE_WORKERS,
+                 upload_workers=UPLOAD_WORKERS, attachment_cache=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.attachment_cache = attachment_cache
+        self.note_workers = note_workers
+        self._upload_pool = ThreadPoolExecutor(max_workers=upload_workers)
 
         self.instance_url = '{}/api/v3'.format(
             self._url_match.group('base_url'))
 
-        # fetch project_id via api, thanks to lewicki-pk
-        # https://github.com/oasiswork/redmine-gitlab-migrator/pull/2
-        # but also take int account, that there might be the same project in different namespaces
+        self.instance_url_v4 = '{}api/v4'.format(
+            self._url_match.group('base_url'))
+
         path_with_namespace = (
             '{namespace}/{project_name}'.format(
                 **self._url_match.groupdict()))
-        projectId = -1
 
-        projects_info = self.api.get('{}/projects'.format(self.instance_url))
+        cache_key = '{}/{}'.format(self.instance_url_v4, path_with_namespace)
+        cached = id_cache.get(cache_key) if id_cache else None
 
-        for project_attributes in projects_info:
-            if project_attributes.get('path_with_namespace') == path_with_namespace:
-                projectId = project_attributes.get('id')
-                if project_attributes.get('namespace').get('kind') == 'group':
-                    groupId = project_attributes.get('namespace').get('id')
+        if cached:
+            projectId, groupId = cached['project_id'], cached['group_id']
+        else:
+            projectId, groupId = self._resolve_ids(path_with_namespace)
+            if id_cache:
+                id_cache.set(
+                    cache_key, {'project_id': projectId, 'group_id': groupId})
 
         self.project_id = projectId
-        if projectId == -1 :
-            raise ValueError('Could not get project_id for path_with_namespace: {}'.format(path_with_namespace))
         self.group_id = groupId
 
         self.api_url = (
@@ -101,102 +292,212 @@ class GitlabProject(Project):
                 **self._url_match.groupdict())) + str(projectId)
 
         self._cache_labels = {}
+        self._labels_lock = threading.Lock()
+
+
+    def _resolve_ids(self, path_with_namespace):
+        """ Fetch project and group ids for a project path
+
+        Looks the project up directly by its URL-encoded path, and only scans
+        the projects listing if that fails.
+
+        :return: couple project_id, group_id (None if not in a group)
+        """
+        project_url = '{}/projects/{}'.format(
+            self.instance_url_v4, quote(path_with_namespace, safe=''))
+        try:
+            candidates = [self.api.get(project_url)]
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # fetch project_id via api, thanks to lewicki-pk
+            # https://github.com/oasiswork/redmine-gitlab-migrator/pull/2
+            # but also take int account, that there might be the same project in different namespaces
+            candidates = self.get_instance().iter_projects()
+
+        for project_attributes in candidates:
+            if project_attributes.get('path_with_namespace') == path_with_namespace:
+                namespace = project_attributes.get('namespace', {})
+                if namespace.get('kind') == 'group':
+                    return project_attributes['id'], namespace.get('id')
+                return project_attributes['id'], None
 
+        raise ValueError('Could not get project_id for path_with_namespace: {}'.format(path_with_namespace))
 
     def is_repository_empty(self):
         """ Heuristic to check if repository is empty
         """
         return self.api.get(self.api_url)['default_branch'] is None
 
-    def uploads_to_string(self, uploads):
+    def upload(self, u):
+        """ Uploads a redmine attachment to the project
 
+        Goes through the attachment cache, if any, so that attachments are
+        downloaded once and identical contents uploaded once.
+
+        :param u: upload, as returned by converters.convert_attachment()
+        :return: the markdown referencing the upload
+        """
+        if self.attachment_cache is None or u.get('id') is None:
+            # spooled, so that the upload can be retried without
+            # downloading again, and kept in memory only when small
+            with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE) as f:
+                with Transfer('downloaded {}'.format(u['filename'])) as t:
+                    with closing(self.api.open(u['content_url'])) as stream:
+                        t.size = copy_stream(stream, f)
+                return self._upload(u, f)
+
+        cache = self.attachment_cache
+        sha = cache.fetch(
+            u['id'], u.get('digest'), lambda: self.api.open(u['content_url']))
+
+        # identical contents are uploaded once, and referenced many times
+        with cache.lock('upload:{}'.format(sha)):
+            markdown = cache.get_upload(self.public_url, sha)
+            if markdown is None:
+                with open(cache.blob_path(sha), 'rb') as f:
+                    markdown = self._upload(u, f)
+                cache.set_upload(self.public_url, sha, markdown)
+            else:
+                log.info('\t{} already uploaded'.format(u['filename']))
+
+        return markdown
+
+    def _upload(self, u, fileobj):
+        """
+        :param fileobj: seekable file-like object to upload, streamed
+        :return: the upload markdown
+        """
         uploads_url = '{}/uploads'.format(self.api_url)
-        l = []
-        for u in uploads:
 
-           log.info('\tuploading {} ({} / {})'.format(u['filename'], u['content_url'], u['content_type']))
+        log.info('\tuploading {} ({} / {})'.format(u['filename'], u['content_url'], u['content_type']))
 
-           # http://docs.python-requests.org/en/latest/user/quickstart/#post-a-multipart-encoded-file
-           # http://stackoverflow.com/questions/20830551/how-to-streaming-upload-with-python-requests-module-include-file-and-data
-           files = [("file", (u['filename'], urlopen(u['content_url']), u['content_type']))]
+        def post(filename):
+            body = MultipartFile('file', filename, fileobj, u['content_type'])
+            with Transfer('uploaded {}'.format(filename)) as t:
+                upload = self.api.post(
+                    uploads_url, data=body, headers=body.headers)
+                t.size = len(body)
+            return upload
+
+        try:
+            upload = post(u['filename'])
+        except requests.exceptions.HTTPError:
+            # gitlab might throw an "ArgumentError (invalid byte sequence in UTF-8)" in production.log
+            # if the filename contains special chars like german "umlaute"
+            # in that case we retry with an ascii only filename.
+            upload = post(self.remove_non_ascii(u['filename']))
 
-           try:
-               upload = self.api.post(
-                   uploads_url, files=files)
-           except requests.exceptions.HTTPError:
-               # gitlab might throw an "ArgumentError (invalid byte sequence in UTF-8)" in production.log
-               # if the filename contains special chars like german "umlaute"
-               # in that case we retry with an ascii only filename.
-               files = [("file", (self.remove_non_ascii(u['filename']), urlopen(u['content_url']), u['content_type']))]
-               upload = self.api.post(
-                   uploads_url, files=files)
+        return upload['markdown']
 
-           l.append('{} {}'.format(upload['markdown'], u['description']))
+    def submit_uploads(self, uploads):
+        """ Starts uploading attachments on the project upload pool
 
-        return "\n  * ".join(l)
+        The pool is shared by all issues, so that the attachments of an issue
+        can be uploaded while previous issues are still being created.
+
+        :return: list of futures of upload(), in the order of uploads
+        """
+        return [self._upload_pool.submit(self.upload, u) for u in uploads]
+
+    def uploads_to_string(self, uploads, pending=None):
+        """
+        :param pending: futures returned by submit_uploads() for these
+            uploads, if they were already started
+        :return: the uploads markdown, in the order of uploads
+        """
+        if pending is None:
+            pending = self.submit_uploads(uploads)
+        return "\n  * ".join(
+            '{} {}'.format(f.result(), u['description'])
+            for u, f in zip(uploads, pending))
 
     def remove_non_ascii(self, text):
         # http://stackoverflow.com/a/20078869/98491
         return ''.join([i if ord(i) < 128 else ' ' for i in text])
 
-    def create_issue(self, data, meta):
+    def create_issue(self, data, meta, on_created=None):
         """ High-level issue creation
 
-        :param meta: dict with "sudo_user", "must_close", "notes" and "attachments" keys
+        :param meta: dict with "sudo_user", "must_close", "notes" and "attachments" keys,
+            "notes" being a list of (data, meta) couples, and optionally
+            "pending_uploads", see submit_uploads()
         :param data: dict formatted as the gitlab API expects it
+        :param on_created: called with the issue as soon as it is created,
+            before its notes are posted
         :return: the created issue (without notes)
         """
 
         # attachments have to be uploaded prior to creating an issue
         # attachments are not related to an issue but can be referenced instead
         # see: https://docs.gitlab.com/ce/api/projects.html#upload-a-file
-        api_key_orig = self.api.api_key
-
-        uploads_text = self.uploads_to_string(meta['uploads'])
+        uploads_text = self.uploads_to_string(
+            meta['uploads'], meta.get('pending_uploads'))
         if len(uploads_text) > 0:
            data['description'] = "{}\n* Uploads:\n  * {}".format(data['description'], uploads_text)
 
-        headers = {}
-        if 'sudo_user' in meta:
-            headers['SUDO'] = meta['sudo_user']
-
-        if meta.get('fake_sudo', None):
-            self.api.api_key = meta['fake_sudo']
+        # impersonate the author, either through admin sudo, or with the
+        # user own key (fake_sudo)
+        credentials = {
+            'sudo': meta.get('sudo_user', None),
+            'api_key': meta.get('fake_sudo', None),
+        }
 
         issues_url = '{}/issues'.format(self.api_url)
         issue = self.api.post(
-            issues_url, data=data, headers=headers)
-
-        self.api.api_key = api_key_orig
+            issues_url, data=data, recover=lambda: self.find_issue(data),
+            **credentials)
+        if on_created is not None:
+            on_created(issue)
 
         issue_url = '{}/{}'.format(issues_url, issue['id'])
 
-        # Handle issues notes
+        # Handle issues notes, they hold their creation date, so gitlab
+        # orders them by date whatever the order they are posted in.
         issue_notes_url = '{}/notes'.format(issue_url, 'notes')
-        for note_data, note_meta in meta['notes']:
-            note_headers = {}
-            if 'sudo_user' in note_meta:
-                note_headers['SUDO'] = note_meta['sudo_user']
-
-            if note_meta.get('fake_sudo', None):
-                self.api.api_key = note_meta['fake_sudo']
 
-            self.api.post(
+        def post_note(note):
+            note_data, note_meta = note
+            return self.api.post(
                 issue_notes_url, data=note_data,
-                headers=note_headers)
+                recover=lambda: self.find_note(issue_notes_url, note_data),
+                sudo=note_meta.get('sudo_user', None),
+                api_key=note_meta.get('fake_sudo', None))
 
-            self.api.api_key = api_key_orig
+        for _ in imap(post_note, meta['notes'], workers=self.note_workers):
+            pass
 
         # Handle closed status
         if meta['must_close']:
-            if meta.get('fake_sudo', None):
-                self.api.api_key = meta['fake_sudo']
+            self.api.put(
+                issue_url, {'state_event': 'close'},
+                api_key=credentials['api_key'])
 
-            self.api.put(issue_url, {'state_event': 'close'})
+        return issue
 
-            self.api.api_key = api_key_orig
+    def find_issue(self, data):
+        """ Looks up the issue created from data, e.g. after a failed request
 
-        return issue
+        :return: the issue, None if not found
+        """
+        issues = self.api.get(
+            '{}/issues'.format(self.api_url_v4),
+            params={'search': data['title'], 'in': 'title'})
+        found = [i for i in issues
+                 if i['title'] == data['title']
+                 and _same_date(i.get('created_at'), data.get('created_at'))]
+        return max(found, key=lambda i: i['id']) if found else None
+
+    def find_note(self, notes_url, data):
+        """ Looks up the note created from data, e.g. after a failed request
+
+        :return: the note, None if not found
+        """
+        for note in self.api.get(notes_url):
+            if (note['body'] == data['body']
+                    and _same_date(note.get('created_at'), data.get('created_at'))):
+                return note
+        return None
 
     def delete_issue(self, iid):
         issue_url = '{}/issues/{}'.format(self.api_url, iid)
@@ -233,7 +534,11 @@ class GitlabProject(Project):
         """
         labels_url = '{}/labels'.format(self.api_url)
 
-        # create label if not exists
+        # create label if not exists, once even if concurrently requested
+        with self._labels_lock:
+            return self._create_label(labels_url, data)
+
+    def _create_label(self, labels_url, data):
         label = self._cache_labels.get(data['name'], None)
 
         if not label:
@@ -247,7 +552,8 @@ class GitlabProject(Project):
                 data['color'] = "#9A90C5"
 
             try:
-                label = self.api.post(labels_url, data=data)
+                # a label created twice is a conflict, handled below
+                label = self.api.post(labels_url, data=data, idempotent=True)
                 self._cache_labels[label['name']] = label
             except HTTPError as e:
                 if "Conflict for url" in str(e):
@@ -266,18 +572,17 @@ class GitlabProject(Project):
         :param iid: issue id
         :return: the created milestone
         """
-        api_key_orig = self.api.api_key
-        self.api.api_key = meta.get('fake_sudo', api_key_orig)
-
         watchers_url = '{}/issues/{}/award_emoji'.format(self.api_url_v4, iid)
-        watcher = self.api.post(watchers_url, data=data)
+        return self.api.post(
+            watchers_url, data=data, api_key=meta.get('fake_sudo', None))
 
-        self.api.api_key = api_key_orig
-
-        return watcher
+    def iter_issues(self):
+        """ Iterates over the project issues (keyset paginated)
+        """
+        return self.api.iter_keyset('{}/issues'.format(self.api_url_v4))
 
     def get_issues(self):
-        return self.api.get('{}/issues'.format(self.api_url))
+        return list(self.iter_issues())
 
     def get_members(self):
         project_members = self.api.get('{}/members'.format(self.api_url))
@@ -325,5 +630,6 @@ class GitlabProject(Project):
     def get_instance(self):
         """ Return a GitlabInstance
         """
-        return GitlabInstance(self.instance_url, self.api)
+        return GitlabInstance(
+            self.instance_url, self.api, url_v4=self.instance_url_v4)
 
@@ -0,0 +1,88 @@
+""" Streaming multipart/form-data encoding, for large file uploads
+"""
+
+import logging
+import os
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+class MultipartFile:
+    """ multipart/form-data request body holding a single file
+
+    Unlike ``requests`` ``files=`` argument, which builds the whole body in
+    memory, the file is read by chunks while the body is sent. The file must
+    be seekable: its size is known upfront (so that the body has a
+    Content-Length) and the body can be sent again, e.g. on retries.
+
+    To be given as ``data``, along with the ``headers`` property.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, field, filename, fileobj, content_type):
+        self.filename = filename
+        self.fileobj = fileobj
+        self.boundary = uuid.uuid4().hex
+
+        # quoting as browsers do, see
+        # https://html.spec.whatwg.org/#multipart-form-data
+        quoted = filename.translate({
+            ord('"'): '%22', ord('\r'): '%0D', ord('\n'): '%0A'})
+        self._head = (
+            '--{}\r\n'
+            'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'
+            'Content-Type: {}\r\n\r\n'.format(
+                self.boundary, field, quoted, content_type)).encode('utf-8')
+        self._tail = '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+
+        self.file_size = fileobj.seek(0, os.SEEK_END)
+
+    @property
+    def headers(self):
+        return {'Content-Type': 'multipart/form-data; boundary={}'.format(
+            self.boundary)}
+
+    def __len__(self):
+        return len(self._head) + self.file_size + len(self._tail)
+
+    def __iter__(self):
+        self.fileobj.seek(0)
+        yield self._head
+        for chunk in iter(lambda: self.fileobj.read(self.CHUNK_SIZE), b''):
+            yield chunk
+        yield self._tail
+
+
+def copy_stream(src, dst, chunk_size=MultipartFile.CHUNK_SIZE):
+    """ Copies a file-like object to another, by chunks
+
+    :return: the number of bytes copied
+    """
+    size = 0
+    for chunk in iter(lambda: src.read(chunk_size), b''):
+        dst.write(chunk)
+        size += len(chunk)
+    return size
+
+
+class Transfer:
+    """ Context manager logging the size and throughput of a transfer
+
+    The transferred size is to be set on ``size`` before leaving.
+    """
+    def __init__(self, description):
+        self.description = description
+        self.size = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self._start
+        if exc_type is None:
+            log.info('\t{}: {} bytes in {:.1f}s ({:.0f} KiB/s)'.format(
+                self.description, self.size, self.elapsed,
+                self.size / 1024 / max(self.elapsed, 1e-6)))
@@ -0,0 +1,122 @@
+""" Helpers to run migration steps as concurrent, streaming stages
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+def imap(func, iterable, workers=1, ordered=True, buffer_size=None):
+    """ Lazily maps a function over an iterable with a pool of workers
+
+    At most ``buffer_size`` items are pending (being processed, or processed
+    and waiting to be consumed), which bounds memory and lets several
+    imap() be chained as stages of a pipeline: each stage pulls from the
+    previous one while its own results are consumed, so all the stages run
+    at the same time.
+
+    :param workers: number of threads processing items
+    :param ordered: if True, results are yielded in the input order, else
+        as soon as they are ready
+    :param buffer_size: max number of pending items, default twice the
+        number of workers
+    :return: a generator of results
+    """
+    if buffer_size is None:
+        buffer_size = 2 * workers
+    buffer_size = max(buffer_size, workers, 1)
+
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit_next():
+            for item in iterator:
+                return executor.submit(func, item)
+            return None
+
+        pending = deque()
+        for _ in range(buffer_size):
+            future = submit_next()
+            if future is None:
+                break
+            pending.append(future)
+
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+
+            for future in done:
+                result = future.result()
+                future = submit_next()
+                if future is not None:
+                    pending.append(future)
+                yield result
+
+
+def imap_fair(func, iterable, delay, workers=1, buffer_size=None):
+    """ Lazily maps a function over an iterable, deferring throttled items
+
+    Like imap(..., ordered=False), but an item is only started once
+    ``delay(item)`` is 0. Up to ``buffer_size`` items are read ahead, and
+    whenever a worker is free, the first ready one is started, so that the
+    items which have to wait (e.g. for the rate limit of their author) do
+    not hold back the others.
+
+    :param delay: callable returning how long (in seconds) an item has to
+        wait before being started, 0 if it is ready
+    :param workers: number of threads processing items
+    :param buffer_size: max number of items read ahead, default four times
+        the number of workers
+    :return: a generator of results, in completion order
+    """
+    if buffer_size is None:
+        buffer_size = 4 * workers
+    buffer_size = max(buffer_size, workers, 1)
+
+    iterator = iter(iterable)
+    waiting = []
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        while True:
+            while not exhausted and len(waiting) < buffer_size:
+                try:
+                    waiting.append(next(iterator))
+                except StopIteration:
+                    exhausted = True
+
+            # start ready items on free workers
+            next_ready = None
+            still_waiting = []
+            for item in waiting:
+                if len(running) < workers:
+                    item_delay = delay(item)
+                    if item_delay <= 0:
+                        running.add(executor.submit(func, item))
+                        continue
+                    if next_ready is None or item_delay < next_ready:
+                        next_ready = item_delay
+                still_waiting.append(item)
+            waiting = still_waiting
+
+            if not running:
+                if not waiting:
+                    return
+                log.debug('All {} pending items throttled, waiting {:.1f}s'.format(
+                    len(waiting), next_ready))
+                time.sleep(next_ready)
+                continue
+
+            # wake up on a completion, or when a throttled item gets ready
+            timeout = next_ready if len(running) < workers else None
+            done, running = wait(
+                running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
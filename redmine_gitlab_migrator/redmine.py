@@ -1,15 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
+import logging
+import math
 import re
+import threading
+
+from requests import HTTPError
 
 from . import APIClient, Project
+from .cache import SpillList
+from .pipeline import imap
+
+log = logging.getLogger(__name__)
 
 ANONYMOUS_USER_ID = 2
 
+
+def issue_user_ids(issue):
+    """ Returns the ids of the users an issue refers to
+
+    Author, assignee, watchers and notes authors, as used by the conversion.
+
+    :rtype: set
+    """
+    users = chain(
+        [issue['author'], issue.get('assigned_to', None)],
+        issue.get('watchers', []),
+        (entry['user'] for entry in issue.get('journals', [])
+         if entry.get('notes', None)))
+    return set(i['id'] for i in users if i is not None)
+
 class RedmineClient(APIClient):
     PAGE_MAX_SIZE = 100
 
-    def get_auth_headers(self):
-        return {"X-Redmine-API-Key": self.api_key}
+    def get_auth_headers(self, api_key, sudo=None):
+        headers = {"X-Redmine-API-Key": api_key}
+        if sudo:
+            headers["X-Redmine-Switch-User"] = sudo
+        return headers
 
     def get(self, *args, **kwargs):
         # In detail views, redmine encapsulate "foo" typed objects under a
@@ -21,13 +49,19 @@ class RedmineClient(APIClient):
         else:
             return ret
 
-    def unpaginated_get(self, *args, **kwargs):
+    def unpaginated_get(self, url, **kwargs):
         """ Iterates over API pagination for a given resource list
+
+        The first page gives the total count, so the remaining pages are then
+        fetched concurrently (at most ``page_workers`` at a time) and merged
+        in order.
+
+        :return: a lazy iterable over all the resources
         """
-        kwargs['params'] = kwargs.get('params', {})
-        kwargs['params']['limit'] = self.PAGE_MAX_SIZE
+        params = dict(kwargs.pop('params', {}))
+        params['limit'] = self.PAGE_MAX_SIZE
 
-        resp = self.get(*args, **kwargs)
+        resp = self.get(url, params=params, **kwargs)
 
         # Try to autofind the top-level key containing
         keys_candidates = (
@@ -36,16 +70,30 @@ class RedmineClient(APIClient):
         assert len(keys_candidates) == 1
         res_list_key = list(keys_candidates)[0]
 
-        result_pages = [resp[res_list_key]]
         if 'offset' not in resp:
             raise ValueError('HTTP response data is not paginated')
 
-        while (resp['total_count'] - resp['offset'] - resp['limit']) > 0:
-            kwargs['params']['offset'] = (kwargs['params'].get('offset', 0)
-                                          + self.PAGE_MAX_SIZE)
-            resp = self.get(*args, **kwargs)
-            result_pages.append(resp[res_list_key])
-        return chain.from_iterable(result_pages)
+        # the server may enforce a lower limit than the requested one
+        page_size = resp['limit'] or self.PAGE_MAX_SIZE
+        offsets = range(
+            resp['offset'] + page_size, resp['total_count'], page_size)
+
+        return chain(
+            resp[res_list_key],
+            self._iter_pages(url, res_list_key, offsets, params, kwargs))
+
+    def _iter_pages(self, url, res_list_key, offsets, params, kwargs):
+        if len(offsets) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            pages = [
+                executor.submit(
+                    self.get, url, params=dict(params, offset=offset),
+                    **kwargs)
+                for offset in offsets]
+            for page in pages:
+                yield from page.result()[res_list_key]
 
 
 class RedmineProject(Project):
@@ -55,11 +103,40 @@ class RedmineProject(Project):
     REGEX_CATEGORY_PROJECT_URL = re.compile(
         r'^(?P<base_url>https?://.*)/project/(?P<category_name>[\w_-]+)/(?P<project_name>[\w_-]+)/?$')
 
-    def __init__(self, url, *args, **kwargs):
+    # Number of issues details fetched concurrently
+    FETCH_WORKERS = 4
+
+    def __init__(self, url, *args, fetch_workers=FETCH_WORKERS, store=None,
+                 offline=False, delta=False, initial_id=None, max_id=None,
+                 memory_limit=None, **kwargs):
         normalized_url = self._canonicalize_url(url)
         super().__init__(normalized_url, *args, **kwargs)
         self.api_url = '{}.json'.format(self.public_url)
         self.instance_url = self._url_match.group('base_url')
+        self.fetch_workers = fetch_workers
+
+        # local snapshot of extracted data (see cache.SnapshotStore), when
+        # offline, data is only read from it and redmine is never requested.
+        self.store = store
+        self.offline = offline
+        if offline and store is None:
+            raise ValueError('Offline mode requires a snapshot store')
+
+        # in delta mode, only issues updated since the last extraction are
+        # listed and fetched, the others are taken from the snapshot store.
+        self.delta = delta
+        if delta and store is None:
+            raise ValueError('Delta mode requires a snapshot store')
+        # ids of the issues updated since the previous extraction, known once
+        # a delta extraction started
+        self.updated_ids = None
+
+        # range of issues ids to extract, bounds included
+        self.initial_id = initial_id
+        self.max_id = max_id
+
+        # max size (bytes) of issues kept in memory, above it they spill to disk
+        self.memory_limit = memory_limit
 
     @classmethod
     def _canonicalize_url(cls, url):
@@ -77,24 +154,101 @@ class RedmineProject(Project):
         else:
             return url
 
+    def get_issue(self, issue_id):
+        issue_url = '{}/issues/{}.json?include=journals,watchers,relations,children,attachments,changesets'.format(
+            self.instance_url, issue_id)
+        return self.api.get(issue_url)
+
+    def in_id_range(self, issue_id):
+        return ((self.initial_id is None or issue_id >= self.initial_id) and
+                (self.max_id is None or issue_id <= self.max_id))
+
     def get_all_issues(self):
 
         if not hasattr(self, '_cache_issues'):
+            if self.memory_limit:
+                issues = SpillList(self.memory_limit)
+            else:
+                issues = []
+            issues.extend(self.iter_issues())
+            self._cache_issues = issues
 
-            issues = self.api.unpaginated_get(
-                '{}/issues.json?status_id=*'.format(self.public_url))
-            detailed_issues = []
-            # It's impossible to get issue history from list view, so get it from
-            # detail view...
-
-            for issue_id in sorted(i['id'] for i in issues):
-                issue_url = '{}/issues/{}.json?include=journals,watchers,relations,children,attachments,changesets'.format(
-                    self.instance_url, issue_id)
-                detailed_issues.append(self.api.get(issue_url))
+        return self._cache_issues
 
-            self._cache_issues = detailed_issues
+    def iter_issues(self):
+        """ Iterates over detailed issues, sorted by id
 
-        return self._cache_issues
+        Unlike get_all_issues(), issues are yielded as soon as they are
+        fetched, so that they can be processed while the next ones are still
+        being extracted.
+        """
+        if hasattr(self, '_cache_issues'):
+            return iter(self._cache_issues)
+        elif self.offline:
+            return (i for i in self.store.get_issues(self.public_url)
+                    if self.in_id_range(i['id']))
+        else:
+            return self._fetch_issues()
+
+    @property
+    def _high_water_mark_key(self):
+        return 'issues_updated_on:{}'.format(self.public_url)
+
+    def _fetch_issues(self):
+        params = {'status_id': '*'}
+        high_water_mark = None
+        if self.delta:
+            high_water_mark = self.store.get_meta(self._high_water_mark_key)
+        if high_water_mark:
+            params['updated_on'] = '>={}'.format(high_water_mark)
+            log.info('Fetching redmine issues updated since {}'.format(
+                high_water_mark))
+
+        # let redmine filter the id range, as well as this side in case the
+        # filter is not supported
+        if self.initial_id is not None and self.max_id is not None:
+            params['issue_id'] = '><{}|{}'.format(self.initial_id, self.max_id)
+        elif self.initial_id is not None:
+            params['issue_id'] = '>={}'.format(self.initial_id)
+        elif self.max_id is not None:
+            params['issue_id'] = '<={}'.format(self.max_id)
+
+        issues = self.api.unpaginated_get(
+            '{}/issues.json'.format(self.public_url), params=params)
+        updated_on = {
+            i['id']: i.get('updated_on') for i in issues
+            if self.in_id_range(i['id'])}
+
+        issues_ids = set(updated_on)
+        if high_water_mark:
+            self.updated_ids = set(updated_on)
+            # Unchanged issues are taken from the snapshot
+            issues_ids.update(
+                i for i in self.store.get_issues_ids(self.public_url)
+                if self.in_id_range(i))
+
+        def get_fresh_issue(issue_id):
+            if self.store is None:
+                return self.get_issue(issue_id)
+
+            issue = self.store.get_issue(issue_id, updated_on.get(issue_id))
+            if issue is None:
+                issue = self.get_issue(issue_id)
+                self.store.put_issue(self.public_url, issue)
+            return issue
+
+        # It's impossible to get issue history from list view, so get it from
+        # detail view, with a bounded pool of workers.
+        last_updated_on = high_water_mark or ''
+        for issue in imap(get_fresh_issue, sorted(issues_ids),
+                          workers=self.fetch_workers):
+            last_updated_on = max(last_updated_on, issue.get('updated_on') or '')
+            yield issue
+
+        partial = self.initial_id is not None or self.max_id is not None
+        if self.store is not None and not partial and last_updated_on:
+            # Record the last complete extraction, for a later delta
+            self.store.set_meta(self._high_water_mark_key, last_updated_on)
 
     def get_all_pages(self):
         return self.api.get(
@@ -104,44 +258,178 @@ class RedmineProject(Project):
         return self.api.get(
             '{}/wiki/{}/{}.json'.format(self.public_url, title, version))
 
+    def get_participant_ids(self):
+        """Get ids of users participating on issues, in a single pass
+
+        :rtype: set
+        """
+        user_ids = set()
+
+        for i in self.get_all_issues():
+            user_ids.update(issue_user_ids(i))
+
+        return user_ids - RedmineUsersIndex.IGNORED_IDS
+
     def get_participants(self):
         """Get participating users (issues authors/owners)
 
+        Computed once, then memoized.
+
         :return: list of all users participating on issues
         :rtype: list
         """
-        user_ids = set()
-        users = []
+        if not hasattr(self, '_cache_participants'):
+            self._cache_participants = self.get_users(
+                self.get_participant_ids())
+        return self._cache_participants
 
-        for i in self.get_all_issues():
-            journals = i.get('journals', [])
-            for i in chain(i.get('watchers', []),
-                           [i['author'], i.get('assigned_to', None)]):
-
-                if i is None:
-                    continue
-                user_ids.add(i['id'])
-            for entry in journals:
-                if not entry.get('notes', None):
-                    continue
-                user_ids.add(entry['user']['id'])
-
-        for i in user_ids:
-            # The anonymous user is not really part of the project... // ids are groups defined on our redmine instance
-            if i not in [ANONYMOUS_USER_ID, 35, 36, 37, 39, 52]:
-                users.append(self.api.get('{}/users/{}.json'.format(
-                    self.instance_url, i)))
+    def get_user(self, user_id):
+        """Get a single user, through the snapshot store if any
+
+        :return: the user, None if it does not exist
+        """
+        if self.store is not None:
+            user = self.store.get_user(user_id)
+            if user is not None or self.offline:
+                return user
+
+        try:
+            user = self.api.get('{}/users/{}.json'.format(
+                self.instance_url, user_id))
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            return None
+
+        if self.store is not None:
+            self.store.put_user(user)
+        return user
+
+    def get_lazy_users_index(self):
+        """ Returns a lazy index of users (by user id)
+
+        Unlike get_users_index(), it does not need to walk all the issues
+        first: users are fetched as they are looked up.
+        """
+        return RedmineUsersIndex(self)
+
+    def get_users(self, user_ids):
+        """Get a set of users, through the snapshot store if any
+
+        :return: list of users, sorted by id
+        :rtype: list
+        """
+        if self.offline:
+            users = [self.store.get_user(i) for i in user_ids]
+            return sorted(
+                (i for i in users if i is not None), key=lambda i: i['id'])
+
+        users = self._fetch_users(user_ids)
+        if self.store is not None:
+            for i in users:
+                self.store.put_user(i)
         return users
 
+    def _fetch_users(self, user_ids):
+        """Fetch a set of users
+
+        Users are taken from the bulk users listing when it needs fewer
+        requests than fetching each user, otherwise (or if the listing is
+        not allowed, as it requires admin rights) they are fetched
+        concurrently one by one.
+
+        :return: list of users, sorted by id
+        :rtype: list
+        """
+        if not user_ids:
+            return []
+
+        users_url = '{}/users.json'.format(self.instance_url)
+        # empty status lists users of any status (active, locked...)
+        params = {'status': ''}
+
+        try:
+            total_count = self.api.get(
+                users_url, params=dict(params, limit=1))['total_count']
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 403:
+                raise
+            total_count = None
+
+        pages_count = math.ceil((total_count or 0) / RedmineClient.PAGE_MAX_SIZE)
+        if total_count is not None and pages_count < len(user_ids):
+            users = [
+                i for i in self.api.unpaginated_get(users_url, params=params)
+                if i['id'] in user_ids]
+        else:
+            with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+                users = list(executor.map(
+                    lambda i: self.api.get('{}/users/{}.json'.format(
+                        self.instance_url, i)),
+                    user_ids))
+
+        return sorted(users, key=lambda i: i['id'])
+
     def get_users_index(self):
         """ Returns dict index of users (by user id)
         """
         return {i['id']: i for i in self.get_participants()}
 
     def get_versions(self):
+        if self.offline:
+            return self.store.get_versions(self.public_url) or []
+
         response = self.api.get('{}/versions.json'.format(self.public_url))
+        if self.store is not None:
+            self.store.put_versions(self.public_url, response['versions'])
         return response['versions']
 
     def get_id(self):
         response = self.api.get('{}.json'.format(self.public_url))
-        return response['id']
\ No newline at end of file
+        return response['id']
+
+class RedmineUsersIndex:
+    """ Index of redmine users by id, resolved on demand
+
+    Behaves as the dict returned by RedmineProject.get_users_index(), but
+    fetches users one by one as they are looked up, remembering hits and
+    misses.
+    """
+    # The anonymous user is not really part of the project... // ids are groups defined on our redmine instance
+    IGNORED_IDS = set([ANONYMOUS_USER_ID, 35, 36, 37, 39, 52])
+
+    def __init__(self, project):
+        self.project = project
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def _resolve(self, user_id):
+        if user_id in self.IGNORED_IDS:
+            return None
+
+        with self._lock:
+            if user_id in self._users:
+                return self._users[user_id]
+
+        user = self.project.get_user(user_id)
+
+        with self._lock:
+            self._users[user_id] = user
+        return user
+
+    def get(self, user_id, default=None):
+        user = self._resolve(user_id)
+        return default if user is None else user
+
+    def __contains__(self, user_id):
+        return self._resolve(user_id) is not None
+
+    def __getitem__(self, user_id):
+        user = self._resolve(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def values(self):
+        with self._lock:
+            return [i for i in self._users.values() if i is not None]
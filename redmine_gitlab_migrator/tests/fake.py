@@ -1,3 +1,16 @@
+import io
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests import Response
+
+from redmine_gitlab_migrator import APIClient
+from redmine_gitlab_migrator.gitlab import GitlabClient
+from redmine_gitlab_migrator.redmine import RedmineClient
+
 JOHN = {
     "id": 1,
     "username": "john_smith",
@@ -159,11 +172,19 @@ REDMINE_ISSUE_1439 = {
 
 
 class FakeGitlabClient:
-    def get(self, url):
+    def shared(self, key, func):
+        return func()
+
+    def iter_keyset(self, url):
+        return iter(self.get(url))
+
+    def get(self, url, params=None):
         if url.endswith('/users'):
-            return [JOHN, JACK]
+            username = (params or {}).get('username')
+            return [i for i in (JOHN, JACK)
+                    if username in (None, i['username'])]
 
-        elif url.endswith('api/v3/projects'):
+        elif url.endswith('/projects'):
             return [{
                 "id": 3,
                 "description": None,
@@ -432,7 +453,7 @@ class FakeGitlabClient:
               url.endswith('/projects/brightbox%2Fpuppet/issues')):
             return []
 
-        elif (orl.endswith('/projects/6/members') or	
+        elif (url.endswith('/projects/6/members') or
               url.endswith('/projects/brightbox%2Fpuppet/members')):
             return []
 
@@ -440,96 +461,126 @@ class FakeGitlabClient:
             raise ValueError('No test data for {}'.format(url))
 
 
+REDMINE_USER_83 = {
+    "id": 83,
+    "login": "john_smith",
+    "firstname": "John",
+    "lastname": "Smith",
+    "mail": "johnn@example.com",
+    "created_on": "2014-06-11T06:54:28Z",
+    "last_login_on": "2015-10-09T09:33:10Z"
+}
+
+REDMINE_USER_3 = {
+    "id": 3,
+    "login": "jack_smith",
+    "firstname": "Jack",
+    "lastname": "Smith",
+    "mail": "jack@example.com",
+    "created_on": "2014-06-11T06:54:28Z",
+    "last_login_on": "2015-10-09T09:33:10Z"
+}
+
+
 class FakeRedmineClient:
-    def unpaginated_get(self, url):
+    DIASPORA_ISSUES = [
+        {
+            "closed_on": "2015-09-09T15:54:49Z",
+            "updated_on": "2015-09-09T15:54:49Z",
+            "created_on": "2015-08-21T13:29:41Z",
+            "custom_fields": [
+                {
+                    "value": "",
+                    "name": "Upstream Bug",
+                    "id": 2
+                }
+            ],
+            "done_ratio": 100,
+            "start_date": "2015-08-21",
+            "description": "The doc is a bit old",
+            "subject": "Update doc for v1",
+            "assigned_to": {
+                "name": "John Smith",
+                "id": 83
+            },
+            "author": {
+                "name": "Jack Smith",
+                "id": 3
+            },
+            "priority": {
+                "name": "Urgent",
+                "id": 6
+            },
+            "status": {
+                "name": "Fixed",
+                "id": 3
+            },
+            "tracker": {
+                "name": "Evolution",
+                "id": 2
+            },
+            "project": {
+                "name": "Diaspora website",
+                "id": 196
+            },
+            "id": 1732
+        },
+        {
+            "closed_on": "2015-04-03T15:24:30Z",
+            "updated_on": "2015-04-03T15:24:30Z",
+            "created_on": "2015-04-03T14:56:08Z",
+            "custom_fields": [],
+            "done_ratio": 0,
+            "start_date": "2015-04-03",
+            "description": "",
+            "subject": "Support SSL",
+            "author": {
+                "name": "John Smith",
+                "id": 83
+            },
+            "fixed_version": {
+                "id": 66,
+                "name": "v0.11"
+            },
+
+            "priority": {
+                "name": "Normal",
+                "id": 4
+            },
+            "status": {
+                "name": "Nouveau",
+                "id": 1
+            },
+            "tracker": {
+                "name": "Evolution",
+                "id": 2
+            },
+            "project": {
+                "name": "Diaspora website",
+                "id": 196
+            },
+            "id": 1439
+        },
+    ]
+
+    def unpaginated_get(self, url, params=None):
         if '/projects/puppet/issues.json' in url:
             return []
 
-        elif '/projects/diaspora-site/issues.json' in url:
-            return [
-                {
-                    "closed_on": "2015-09-09T15:54:49Z",
-                    "updated_on": "2015-09-09T15:54:49Z",
-                    "created_on": "2015-08-21T13:29:41Z",
-                    "custom_fields": [
-                        {
-                            "value": "",
-                            "name": "Upstream Bug",
-                            "id": 2
-                        }
-                    ],
-                    "done_ratio": 100,
-                    "start_date": "2015-08-21",
-                    "description": "The doc is a bit old",
-                    "subject": "Update doc for v1",
-                    "assigned_to": {
-                        "name": "John Smith",
-                        "id": 83
-                    },
-                    "author": {
-                        "name": "Jack Smith",
-                        "id": 3
-                    },
-                    "priority": {
-                        "name": "Urgent",
-                        "id": 6
-                    },
-                    "status": {
-                        "name": "Fixed",
-                        "id": 3
-                    },
-                    "tracker": {
-                        "name": "Evolution",
-                        "id": 2
-                    },
-                    "project": {
-                        "name": "Diaspora website",
-                        "id": 196
-                    },
-                    "id": 1732
-                },
-                {
-                    "closed_on": "2015-04-03T15:24:30Z",
-                    "updated_on": "2015-04-03T15:24:30Z",
-                    "created_on": "2015-04-03T14:56:08Z",
-                    "custom_fields": [],
-                    "done_ratio": 0,
-                    "start_date": "2015-04-03",
-                    "description": "",
-                    "subject": "Support SSL",
-                    "author": {
-                        "name": "John Smith",
-                        "id": 83
-                    },
-                    "fixed_version": {
-                        "id": 66,
-                        "name": "v0.11"
-                    },
+        elif url.endswith('/users.json'):
+            return [REDMINE_USER_3, REDMINE_USER_83]
 
-                    "priority": {
-                        "name": "Normal",
-                        "id": 4
-                    },
-                    "status": {
-                        "name": "Nouveau",
-                        "id": 1
-                    },
-                    "tracker": {
-                        "name": "Evolution",
-                        "id": 2
-                    },
-                    "project": {
-                        "name": "Diaspora website",
-                        "id": 196
-                    },
-                    "id": 1439
-                },
-            ]
+        elif '/projects/diaspora-site/issues.json' in url:
+            updated_since = (params or {}).get('updated_on', '>=')[2:]
+            issue_id = (params or {}).get('issue_id', '>=0')
+            min_id = int(issue_id[2:]) if issue_id.startswith('>=') else 0
+            return [i for i in self.DIASPORA_ISSUES
+                    if i['updated_on'] >= updated_since and i['id'] >= min_id]
 
         else:
             raise ValueError('{} is unknown data test'.format(url))
 
-    def get(self, url):
+    def get(self, url, params=None):
 
         if url.endswith('projects/brightbox/puppet.json'):
             return {
@@ -611,27 +662,227 @@ class FakeRedmineClient:
                 'total_count': 2,
             }
 
-        elif url.endswith('/users/83.json'):
+        elif url.endswith('/users.json'):
             return {
-                "id": 83,
-                "login": "john_smith",
-                "firstname": "John",
-                "lastname": "Smith",
-                "mail": "johnn@example.com",
-                "created_on": "2014-06-11T06:54:28Z",
-                "last_login_on": "2015-10-09T09:33:10Z"
+                'users': [REDMINE_USER_3, REDMINE_USER_83][:params['limit']],
+                'total_count': 2,
+                'offset': 0,
+                'limit': params['limit'],
             }
 
+        elif url.endswith('/users/83.json'):
+            return REDMINE_USER_83
+
         elif url.endswith('/users/3.json'):
-            return {
-                "id": 3,
-                "login": "jack_smith",
-                "firstname": "Jack",
-                "lastname": "Smith",
-                "mail": "jack@example.com",
-                "created_on": "2014-06-11T06:54:28Z",
-                "last_login_on": "2015-10-09T09:33:10Z"
-            }
+            return REDMINE_USER_3
 
         else:
             raise ValueError('{} is unknown data test'.format(url))
+
+
+class SlowFakeRedmineClient(FakeRedmineClient):
+    """ FakeRedmineClient adding an artificial latency to each request
+    """
+    def __init__(self, latency=0.05):
+        self.latency = latency
+
+    def unpaginated_get(self, url, params=None):
+        time.sleep(self.latency)
+        return super().unpaginated_get(url, params)
+
+    def get(self, url, params=None):
+        time.sleep(self.latency)
+        return super().get(url, params)
+
+
+class PaginatedFakeRedmineClient(RedmineClient):
+    """ RedmineClient serving a paginated list of ``total_count`` fake issues
+    """
+    def __init__(self, total_count, *args, **kwargs):
+        super().__init__('key', True, *args, **kwargs)
+        self.total_count = total_count
+        self.requested_offsets = []
+
+    def _req(self, method, url, **kwargs):
+        params = kwargs.get('params', {})
+        offset = params.get('offset', 0)
+        limit = params['limit']
+        self.requested_offsets.append(offset)
+        ids = range(offset, min(offset + limit, self.total_count))
+        return {
+            'issues': [{'id': i} for i in ids],
+            'total_count': self.total_count,
+            'offset': offset,
+            'limit': limit,
+        }
+
+
+def make_response(data, headers=None, status_code=200):
+    """ Builds a requests.Response holding ``data`` as JSON body
+    """
+    resp = Response()
+    resp.status_code = status_code
+    resp._content = json.dumps(data).encode('utf-8')
+    resp.headers.update(headers or {})
+    return resp
+
+
+class PaginatedFakeGitlabClient(GitlabClient):
+    """ GitlabClient serving a paginated list of ``total_count`` fake users
+
+    :param mode: "totals" to send X-Total-Pages, "next" to only send
+        X-Next-Page, "keyset" to only send a Link header.
+    """
+    def __init__(self, total_count, mode='totals', *args, **kwargs):
+        super().__init__('key', True, *args, **kwargs)
+        self.total_count = total_count
+        self.mode = mode
+        self.requested_urls = []
+
+    def _request(self, method, url, **kwargs):
+        params = kwargs.get('params', {})
+        self.requested_urls.append((url, params))
+        per_page = params.get('per_page', self.MAX_PER_PAGE)
+
+        if 'id_after=' in url:
+            start = int(url.split('id_after=')[1])
+        else:
+            start = (params.get('page', 1) - 1) * per_page
+        ids = list(range(start, min(start + per_page, self.total_count)))
+
+        total_pages = -(-self.total_count // per_page)
+        page = start // per_page + 1
+        headers = {}
+        if self.mode == 'totals':
+            headers['X-Total-Pages'] = str(total_pages)
+        if page < total_pages:
+            if self.mode in ('totals', 'next'):
+                headers['X-Next-Page'] = str(page + 1)
+            elif self.mode == 'keyset':
+                headers['Link'] = '<{}?id_after={}>; rel="next"'.format(
+                    url.split('?')[0], ids[-1] + 1)
+        return make_response([{'id': i} for i in ids], headers)
+
+
+class RecordingGitlabClient(GitlabClient):
+    """ GitlabClient recording sent requests, and answering write requests
+
+    Each request waits ``latency`` seconds, created objects get increasing
+    ids. The next ``failing_uploads`` uploads fail.
+    """
+    def __init__(self, latency=0, *args, **kwargs):
+        super().__init__('admin-key', True, *args, **kwargs)
+        self.latency = latency
+        self.requests = []
+        self.uploaded = []
+        self.failing_uploads = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get_session(self, url):
+        return self
+
+    def open(self, url):
+        time.sleep(self.latency)
+        return io.BytesIO(url.encode())
+
+    def request(self, method, url, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests.append((method, url, kwargs))
+            new_id = next(self._ids)
+
+        if url.endswith('/uploads'):
+            filename = kwargs['data'].filename
+            with self._lock:
+                self.uploaded.append(b''.join(kwargs['data']))
+                if self.failing_uploads:
+                    self.failing_uploads -= 1
+                    return make_response({}, status_code=500)
+            data = {'markdown': '![{0}](/uploads/{1}/{0})'.format(
+                filename, new_id)}
+        elif method == 'POST' and url.endswith('/issues'):
+            data = dict(kwargs['data'], id=new_id, iid=new_id)
+        elif method == 'POST':
+            data = dict(kwargs.get('data') or {}, id=new_id)
+        else:
+            data = {}
+        return make_response(data)
+
+
+class ScriptedClient(APIClient):
+    """ APIClient answering requests from a script
+
+    :param script: list of responses (or exceptions, raised) to send back,
+        one per request
+    """
+    def __init__(self, script, *args, **kwargs):
+        kwargs.setdefault('backoff', 0.001)
+        super().__init__('key', True, *args, **kwargs)
+        self.script = list(script)
+        self.requests = []
+
+    def get_session(self, url):
+        return self
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, time.perf_counter()))
+        answer = self.script.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class StandInServer:
+    """ Local HTTP server, standing in for redmine or gitlab
+
+    Requests are answered by ``handler(method, path, body)``, returning a
+    ``(status, headers, data)`` tuple, data being sent as JSON. To be used
+    as a context manager.
+
+    Received requests are kept as ``(method, path)`` in ``requests``, their
+    headers in ``headers``.
+    """
+    def __init__(self, handler):
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def answer(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                with outer._lock:
+                    outer.requests.append((self.command, self.path))
+                    outer.headers.append(dict(self.headers))
+                status, headers, data = handler(self.command, self.path, body)
+                content = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = answer
+
+            def log_message(self, *args):
+                pass
+
+        self.requests = []
+        self.headers = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        # clients giving up (timeouts) are expected
+        self._server.handle_error = lambda request, client_address: None
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,246 @@
+import asyncio
+import itertools
+import threading
+import unittest
+from urllib.parse import parse_qs, urlsplit
+
+from redmine_gitlab_migrator.gitlab import GitlabClient, GitlabProject
+from redmine_gitlab_migrator.redmine import RedmineClient, RedmineProject
+
+from .fake import StandInServer
+
+try:
+    import aiohttp
+    from redmine_gitlab_migrator import aio
+except ImportError:
+    aiohttp = None
+
+
+def query(path):
+    return {k: v[0] for k, v in parse_qs(urlsplit(path).query).items()}
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncAPIClientTestCase(unittest.TestCase):
+    def test_retry_get(self):
+        count = itertools.count()
+
+        def handler(method, path, body):
+            if next(count) < 2:
+                return 502, {}, {}
+            return 200, {}, {'path': path}
+
+        async def run(url):
+            async with aio.AsyncAPIClient('key', True, backoff=0.001) as client:
+                return await client.get(url + '/foo')
+
+        with StandInServer(handler) as server:
+            self.assertEqual(asyncio.run(run(server.url)), {'path': '/foo'})
+            self.assertEqual(len(server.requests), 3)
+
+    def test_post_not_retried(self):
+        async def run(url):
+            async with aio.AsyncAPIClient('key', True, backoff=0.001) as client:
+                return await client.post(url + '/issues', data={'title': 'a'})
+
+        with StandInServer(lambda *args: (502, {}, {})) as server:
+            with self.assertRaises(aiohttp.ClientResponseError):
+                asyncio.run(run(server.url))
+            self.assertEqual(len(server.requests), 1)
+
+    def test_post_recovered(self):
+        async def recover():
+            return {'id': 42}
+
+        async def run(url):
+            async with aio.AsyncAPIClient('key', True, backoff=0.001) as client:
+                return await client.post(
+                    url + '/issues', data={'title': 'a'}, recover=recover)
+
+        with StandInServer(lambda *args: (502, {}, {})) as server:
+            self.assertEqual(asyncio.run(run(server.url)), {'id': 42})
+            self.assertEqual(len(server.requests), 1)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncPaginationTestCase(unittest.TestCase):
+    USERS = [{'id': i} for i in range(1, 251)]
+
+    def gitlab_handler(self, mode):
+        def handler(method, path, body):
+            params = query(path)
+            page = int(params['page'])
+            per_page = int(params['per_page'])
+            headers = {}
+            if mode == 'totals':
+                headers['X-Total-Pages'] = '3'
+            elif page < 3:
+                headers['Link'] = '<http://{}{}?page={}&per_page={}>; rel="next"'.format(
+                    self.host, urlsplit(path).path, page + 1, per_page)
+            return 200, headers, self.USERS[(page - 1) * 100:page * 100]
+        return handler
+
+    def get_users(self, url):
+        async def run():
+            async with aio.AsyncGitlabClient('key', True) as client:
+                return await client.get(url + '/api/v4/users')
+        return asyncio.run(run())
+
+    def test_gitlab_total_pages(self):
+        with StandInServer(self.gitlab_handler('totals')) as server:
+            self.assertEqual(self.get_users(server.url), self.USERS)
+            self.assertEqual(len(server.requests), 3)
+
+    def test_gitlab_link(self):
+        with StandInServer(self.gitlab_handler('link')) as server:
+            self.host = urlsplit(server.url).netloc
+            self.assertEqual(self.get_users(server.url), self.USERS)
+            self.assertEqual(len(server.requests), 3)
+
+    def test_gitlab_keyset_fallback(self):
+        def handler(method, path, body):
+            if query(path).get('pagination') == 'keyset':
+                return 400, {}, {'message': 'not supported'}
+            return 200, {}, self.USERS[:10]
+
+        async def run(url):
+            async with aio.AsyncGitlabClient('key', True) as client:
+                return [i async for i in client.iter_keyset(url + '/api/v4/users')]
+
+        with StandInServer(handler) as server:
+            self.assertEqual(asyncio.run(run(server.url)), self.USERS[:10])
+            self.assertEqual(len(server.requests), 2)
+
+    def test_redmine_unpaginated_get(self):
+        def handler(method, path, body):
+            offset = int(query(path).get('offset', 0))
+            return 200, {}, {
+                'issues': self.USERS[offset:offset + 100],
+                'total_count': 250, 'offset': offset, 'limit': 100}
+
+        async def run(url):
+            async with aio.AsyncRedmineClient('key', True) as client:
+                return await client.unpaginated_get(url + '/issues.json')
+
+        with StandInServer(handler) as server:
+            self.assertEqual(asyncio.run(run(server.url)), self.USERS)
+            self.assertEqual(len(server.requests), 3)
+            self.assertEqual(server.headers[0]['X-Redmine-API-Key'], 'key')
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncProjectsTestCase(unittest.TestCase):
+    def test_iter_issues(self):
+        def handler(method, path, body):
+            if urlsplit(path).path == '/projects/test/issues.json':
+                issues = [{'id': i, 'updated_on': '2020'} for i in (3, 1, 2)]
+                return 200, {}, {
+                    'issues': issues, 'total_count': 3, 'offset': 0, 'limit': 100}
+            issue_id = int(urlsplit(path).path.split('/')[-1].split('.')[0])
+            return 200, {}, {'issue': {'id': issue_id, 'subject': str(issue_id)}}
+
+        async def run(project):
+            async with aio.AsyncRedmineClient('key', True) as client:
+                async_project = aio.AsyncRedmineProject(project, client)
+                return [i['id'] async for i in async_project.iter_issues()]
+
+        with StandInServer(handler) as server:
+            project = RedmineProject(
+                server.url + '/projects/test', RedmineClient('key', True))
+            self.assertEqual(asyncio.run(run(project)), [1, 2, 3])
+
+    def test_iter_issues_bounded(self):
+        def handler(method, path, body):
+            if urlsplit(path).path == '/projects/test/issues.json':
+                issues = [{'id': i, 'updated_on': '2020'} for i in range(1, 11)]
+                return 200, {}, {
+                    'issues': issues, 'total_count': 10, 'offset': 0, 'limit': 100}
+            issue_id = int(urlsplit(path).path.split('/')[-1].split('.')[0])
+            return 200, {}, {'issue': {'id': issue_id}}
+
+        async def run(project, server):
+            async with aio.AsyncRedmineClient('key', True) as client:
+                issues = aio.AsyncRedmineProject(project, client).iter_issues()
+                first = await issues.__anext__()
+                await asyncio.sleep(0.2)
+                # the listing, plus the details of the fetch_workers next ones
+                fetched = len(server.requests)
+                await issues.aclose()
+                return first['id'], fetched
+
+        with StandInServer(handler) as server:
+            project = RedmineProject(
+                server.url + '/projects/test', RedmineClient('key', True),
+                fetch_workers=2)
+            self.assertEqual(asyncio.run(run(project, server)), (1, 1 + 3))
+
+    def test_create_issue(self):
+        ids = itertools.count(1)
+        lock = threading.Lock()
+
+        def handler(method, path, body):
+            path = urlsplit(path).path
+            if path == '/api/v4/projects/group%2Fproject':
+                return 200, {}, {
+                    'id': 7, 'path_with_namespace': 'group/project',
+                    'namespace': {'kind': 'group', 'id': 3}}
+            with lock:
+                new_id = next(ids)
+            if method == 'POST' and path.endswith('/issues'):
+                return 201, {}, {'id': new_id, 'iid': new_id, 'title': 'a'}
+            return 200, {}, {'id': new_id}
+
+        async def run(project):
+            async with aio.AsyncGitlabClient('key', True) as client:
+                async_project = aio.AsyncGitlabProject(
+                    project, client, note_workers=2)
+                return await async_project.create_issue(
+                    {'title': 'a', 'description': 'b'}, {
+                        'sudo_user': 'john', 'uploads': [], 'must_close': True,
+                        'notes': [({'body': str(i)}, {'sudo_user': 'jack'})
+                                  for i in range(3)]})
+
+        with StandInServer(handler) as server:
+            project = GitlabProject(
+                server.url + '/group/project', GitlabClient('key', True))
+            created = asyncio.run(run(project))
+            self.assertEqual(created['title'], 'a')
+
+            requests = server.requests[1:]
+            headers = server.headers[1:]
+            self.assertEqual(requests[0], ('POST', '/api/v3/projects/7/issues'))
+            self.assertEqual(headers[0]['SUDO'], 'john')
+            self.assertEqual(
+                sorted(requests[1:4]),
+                [('POST', '/api/v3/projects/7/issues/1/notes')] * 3)
+            self.assertEqual([i['SUDO'] for i in headers[1:4]], ['jack'] * 3)
+            self.assertEqual(requests[4], ('PUT', '/api/v3/projects/7/issues/1'))
+
+    def test_upload(self):
+        bodies = []
+
+        def handler(method, path, body):
+            path = urlsplit(path).path
+            if path == '/api/v4/projects/group%2Fproject':
+                return 200, {}, {'id': 7, 'path_with_namespace': 'group/project'}
+            if path == '/attachments/download/1/foo.txt':
+                return 200, {}, 'content'
+            bodies.append(body)
+            if len(bodies) == 1:
+                return 400, {}, {'message': 'invalid filename'}
+            return 201, {}, {'markdown': '[foo](/uploads/foo.txt)'}
+
+        async def run(url, project):
+            async with aio.AsyncGitlabClient('key', True) as client:
+                return await aio.AsyncGitlabProject(project, client).upload({
+                    'filename': 'fóo.txt', 'content_type': 'text/plain',
+                    'content_url': url + '/attachments/download/1/foo.txt'})
+
+        with StandInServer(handler) as server:
+            project = GitlabProject(
+                server.url + '/group/project', GitlabClient('key', True))
+            self.assertEqual(
+                asyncio.run(run(server.url, project)), '[foo](/uploads/foo.txt)')
+            # sent again with an ascii filename, the file being read again
+            self.assertIn(b'"content"', bodies[1])
+            self.assertIn(b'f%20o.txt', bodies[1])
@@ -0,0 +1,152 @@
+import io
+import os
+import tempfile
+import tracemalloc
+import unittest
+
+from redmine_gitlab_migrator.cache import AttachmentCache, SnapshotStore, SpillList
+
+
+class SnapshotStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = SnapshotStore.in_dir(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_issues(self):
+        self.store.put_issue('p1', {'id': 2, 'updated_on': 'b'})
+        self.store.put_issue('p1', {'id': 1, 'updated_on': 'a'})
+        self.store.put_issue('p2', {'id': 3, 'updated_on': 'c'})
+
+        self.assertEqual(
+            [i['id'] for i in self.store.get_issues('p1')], [1, 2])
+        self.assertEqual(self.store.get_issue(1)['updated_on'], 'a')
+        self.assertEqual(self.store.get_issue(1, 'a')['id'], 1)
+        self.assertIsNone(self.store.get_issue(1, 'newer'))
+        self.assertIsNone(self.store.get_issue(42))
+
+    def test_migrated(self):
+        self.store.put_migrated('http://gitlab/a/b', 1439, 1)
+        self.store.put_migrated('http://gitlab/a/b', 1732, 2)
+        self.store.put_migrated('http://gitlab/a/c', 1, 1)
+        self.assertEqual(
+            self.store.get_migrated_ids('http://gitlab/a/b'), {1439, 1732})
+
+    def test_partially_migrated(self):
+        self.store.put_migrated('http://gitlab/a/b', 1439, 1, partial=True)
+        self.store.put_migrated('http://gitlab/a/b', 1732, 2, partial=True)
+        self.store.put_migrated('http://gitlab/a/b', 1732, 2)
+        self.assertEqual(
+            self.store.get_migrated_ids('http://gitlab/a/b'), {1439, 1732})
+        self.assertEqual(
+            self.store.get_partially_migrated('http://gitlab/a/b'), {1439: 1})
+
+    def test_persistence(self):
+        self.store.put_versions('p1', [{'id': 66}])
+        self.store.put_user({'id': 3, 'login': 'jack_smith'})
+        self.store.set_meta('key', 'value')
+        self.store.close()
+
+        self.store = SnapshotStore.in_dir(self.tmp_dir.name)
+        self.assertEqual(self.store.get_versions('p1'), [{'id': 66}])
+        self.assertEqual(self.store.get_user(3)['login'], 'jack_smith')
+        self.assertEqual(self.store.get_meta('key'), 'value')
+        self.assertIsNone(self.store.get_versions('p2'))
+
+
+class AttachmentCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = AttachmentCache.in_dir(self.tmp_dir.name)
+        self.downloads = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def opener(self, content):
+        def open_stream():
+            self.downloads.append(content)
+            return io.BytesIO(content)
+        return open_stream
+
+    def test_fetch(self):
+        sha = self.cache.fetch(1, 'abc', self.opener(b'foo'))
+        with open(self.cache.blob_path(sha), 'rb') as f:
+            self.assertEqual(f.read(), b'foo')
+
+        self.assertEqual(self.cache.fetch(1, 'abc', self.opener(b'foo')), sha)
+        self.assertEqual(
+            AttachmentCache.in_dir(self.tmp_dir.name).get_blob(1, 'abc'), sha)
+        self.assertEqual(self.downloads, [b'foo'])
+
+        # replaced attachment, same id
+        self.assertNotEqual(self.cache.fetch(1, 'def', self.opener(b'bar')), sha)
+
+        # another attachment, same content
+        self.assertEqual(self.cache.fetch(2, None, self.opener(b'foo')), sha)
+        self.assertEqual(len(os.listdir(self.cache.blobs_path)), 2)
+
+    def test_uploads(self):
+        self.cache.set_upload('http://gitlab/a/b', 'sha', '![foo](/uploads/1/foo)')
+        self.assertEqual(
+            self.cache.get_upload('http://gitlab/a/b', 'sha'),
+            '![foo](/uploads/1/foo)')
+        self.assertIsNone(self.cache.get_upload('http://gitlab/a/c', 'sha'))
+        self.assertEqual(
+            AttachmentCache.in_dir(self.tmp_dir.name).get_upload(
+                'http://gitlab/a/b', 'sha'),
+            '![foo](/uploads/1/foo)')
+
+
+class SpillListTestCase(unittest.TestCase):
+    MAX_BYTES = 64 * 1024
+
+    @staticmethod
+    def make_issue(i):
+        return {
+            'id': i,
+            'journals': [{'notes': 'note {} {}'.format(i, j) * 20}
+                         for j in range(10)],
+        }
+
+    def test_in_memory(self):
+        items = SpillList(self.MAX_BYTES)
+        items.extend([{'id': 1}, {'id': 2}])
+        self.assertFalse(items.spilled)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[-1], {'id': 2})
+        self.assertEqual(list(items), [{'id': 1}, {'id': 2}])
+
+    def test_spilled(self):
+        items = SpillList(self.MAX_BYTES)
+        items.extend(self.make_issue(i) for i in range(500))
+        self.assertTrue(items.spilled)
+        self.assertEqual(len(items), 500)
+        self.assertEqual(items[0], self.make_issue(0))
+        self.assertEqual(items[-1]['id'], 499)
+        self.assertEqual([i['id'] for i in items], list(range(500)))
+        with self.assertRaises(IndexError):
+            items[500]
+        items.close()
+
+    def peak_memory(self, count):
+        tracemalloc.start()
+        try:
+            items = SpillList(self.MAX_BYTES)
+            items.extend(self.make_issue(i) for i in range(count))
+            for i in items:
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            items.close()
+
+    def test_memory_stays_flat(self):
+        small = self.peak_memory(500)
+        large = self.peak_memory(4000)
+        # 4000 issues weight ~9MB once JSON encoded
+        self.assertLess(large, 1024 * 1024)
+        self.assertLess(large, 2 * small)
@@ -0,0 +1,212 @@
+import email.utils
+import itertools
+import threading
+import time
+import unittest
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from redmine_gitlab_migrator import APIClient, Timeouts
+
+from .fake import ScriptedClient, StandInServer, make_response
+
+
+class APIClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = APIClient('key', True, pool_size=4)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_session_per_host(self):
+        s1 = self.client.get_session('https://gitlab.example.com/api/v4/users')
+        s2 = self.client.get_session('https://gitlab.example.com/api/v4/projects')
+        s3 = self.client.get_session('https://redmine.example.com/issues.json')
+        self.assertIs(s1, s2)
+        self.assertIsNot(s1, s3)
+        self.assertEqual(
+            s1.get_adapter('https://gitlab.example.com')._pool_maxsize, 4)
+
+    def test_no_keep_alive(self):
+        client = APIClient('key', True, keep_alive=False)
+        session = client.get_session('https://gitlab.example.com/')
+        self.assertEqual(session.headers['Connection'], 'close')
+
+
+class RetryTestCase(unittest.TestCase):
+    URL = 'https://gitlab.example.com/api/v4/projects/1/issues'
+
+    def test_idempotent_retried(self):
+        client = ScriptedClient([
+            make_response({}, status_code=502),
+            requests.ConnectionError('reset'),
+            make_response({'id': 1}),
+        ])
+        self.assertEqual(client.get(self.URL), {'id': 1})
+        self.assertEqual(len(client.requests), 3)
+
+    def test_client_error_not_retried(self):
+        client = ScriptedClient([make_response({}, status_code=404)])
+        with self.assertRaises(requests.HTTPError):
+            client.get(self.URL)
+
+    def test_retries_exhausted(self):
+        client = ScriptedClient(
+            [make_response({}, status_code=503)] * 3, retries=2)
+        with self.assertRaises(requests.HTTPError):
+            client.get(self.URL)
+        self.assertEqual(len(client.requests), 3)
+
+    def test_post_not_processed_retried(self):
+        refused = requests.ConnectionError(
+            MaxRetryError(None, self.URL, NewConnectionError(None, 'refused')))
+        client = ScriptedClient([
+            make_response({}, status_code=429),
+            refused,
+            make_response({'id': 1}),
+        ])
+        self.assertEqual(client.post(self.URL, {}), {'id': 1})
+        self.assertEqual(len(client.requests), 3)
+
+    def test_post_maybe_processed(self):
+        client = ScriptedClient([make_response({}, status_code=502)])
+        with self.assertRaises(requests.HTTPError):
+            client.post(self.URL, {})
+
+        client = ScriptedClient([make_response({}, status_code=502)])
+        self.assertEqual(
+            client.post(self.URL, {}, recover=lambda: {'id': 1}), {'id': 1})
+        self.assertEqual(len(client.requests), 1)
+
+        client = ScriptedClient([
+            requests.ReadTimeout('timeout'),
+            make_response({'id': 2}),
+        ])
+        self.assertEqual(
+            client.post(self.URL, {}, recover=lambda: None), {'id': 2})
+        self.assertEqual(len(client.requests), 2)
+
+    def test_retry_delay(self):
+        client = APIClient('key', True, backoff=1)
+        for attempt in range(10):
+            self.assertLessEqual(
+                client.retry_delay(attempt), min(2 ** attempt, client.MAX_BACKOFF))
+
+        self.assertEqual(client.retry_delay(
+            0, make_response({}, {'Retry-After': '3'})), 3)
+        date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(client.retry_delay(
+            0, make_response({}, {'Retry-After': date})), 30, delta=2)
+        self.assertAlmostEqual(client.retry_delay(0, make_response({}, {
+            'RateLimit-Remaining': '0',
+            'RateLimit-Reset': str(int(time.time()) + 20),
+        })), 20, delta=2)
+
+        # invalid hint, the backoff applies
+        self.assertLessEqual(client.retry_delay(
+            0, make_response({}, {'Retry-After': 'soon'})), 1)
+
+    def test_rate_limit_exhausted(self):
+        client = ScriptedClient([
+            make_response({}, {
+                'RateLimit-Remaining': '0',
+                'RateLimit-Reset': str(time.time() + 0.2)}),
+            make_response({}),
+        ])
+        client.get(self.URL)
+        client.get(self.URL)
+        (_, _, first), (_, _, second) = client.requests
+        self.assertGreaterEqual(second - first, 0.15)
+
+
+class TimeoutsTestCase(unittest.TestCase):
+    def handler(self, method, path, body):
+        if path.startswith('/slow'):
+            time.sleep(0.5)
+        return 200, {}, {'path': path}
+
+    def test_read_timeout(self):
+        client = APIClient('key', True, retries=0, timeouts=Timeouts(1, 0.1, None))
+        with StandInServer(self.handler) as server:
+            self.assertEqual(client.get(server.url + '/fast'), {'path': '/fast'})
+            with self.assertRaises(requests.Timeout):
+                client.get(server.url + '/slow')
+        client.close()
+
+    def test_total_timeout(self):
+        client = APIClient('key', True, retries=0, timeouts=Timeouts(1, 5, 0.2))
+        with StandInServer(self.handler) as server:
+            start = time.perf_counter()
+            with self.assertRaises(requests.Timeout):
+                client.get(server.url + '/slow')
+            self.assertLess(time.perf_counter() - start, 0.4)
+        client.close()
+
+    def test_endpoint_timeouts(self):
+        client = APIClient('key', True, retries=0, endpoint_timeouts=[
+            (r'/slow/\d+$', Timeouts(1, 0.1, None))])
+        with StandInServer(self.handler) as server:
+            self.assertEqual(
+                client.get(server.url + '/slow/1/foo'), {'path': '/slow/1/foo'})
+            with self.assertRaises(requests.Timeout):
+                client.get(server.url + '/slow/1')
+        client.close()
+
+    def test_hedge(self):
+        count = itertools.count()
+
+        def handler(method, path, body):
+            # the 21st request hangs
+            if next(count) == 20:
+                time.sleep(1)
+            return 200, {}, {'path': path}
+
+        client = APIClient('key', True, hedge=True)
+        with StandInServer(handler) as server:
+            for i in range(20):
+                client.get('{}/issues/{}.json'.format(server.url, i))
+
+            start = time.perf_counter()
+            self.assertEqual(
+                client.get(server.url + '/issues/42.json'),
+                {'path': '/issues/42.json'})
+            self.assertLess(time.perf_counter() - start, 0.5)
+            self.assertEqual(len(server.requests), 22)
+        client.close()
+
+
+class SharedGetTestCase(unittest.TestCase):
+    def handler(self, method, path, body):
+        time.sleep(0.1)
+        return 200, {}, {'path': path}
+
+    def test_concurrent_gets(self):
+        client = APIClient('key', True)
+        with StandInServer(self.handler) as server:
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(
+                    client.get(server.url + '/users', params={'page': 1})))
+                for _ in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(results, [{'path': '/users?page=1'}] * 10)
+            self.assertEqual(len(server.requests), 1)
+        client.close()
+
+    def test_memo(self):
+        client = APIClient('key', True, memo_ttl=60)
+        with StandInServer(self.handler) as server:
+            client.get(server.url + '/users')
+            client.get(server.url + '/users')
+            client.get(server.url + '/users', api_key='other')
+            self.assertEqual(len(server.requests), 2)
+
+            client.post(server.url + '/users', {'username': 'john'})
+            client.get(server.url + '/users')
+            self.assertEqual(len(server.requests), 4)
+        client.close()
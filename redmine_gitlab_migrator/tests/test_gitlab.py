@@ -1,9 +1,56 @@
+import io
+import os
+import tempfile
+import time
 import unittest
 
-from .fake import FakeGitlabClient
+from requests import HTTPError
+
+from .fake import (
+    FakeGitlabClient, PaginatedFakeGitlabClient, RecordingGitlabClient,
+    make_response)
+from redmine_gitlab_migrator.cache import AttachmentCache, IdCache
 from redmine_gitlab_migrator.gitlab import GitlabInstance, GitlabProject
 
 
+class GitlabClientTestCase(unittest.TestCase):
+    URL = 'http://localhost:3000/api/v4/users'
+
+    def test_total_pages(self):
+        client = PaginatedFakeGitlabClient(250)
+        users = client.get(self.URL)
+        self.assertEqual([i['id'] for i in users], list(range(250)))
+        self.assertEqual(
+            sorted(p['page'] for _, p in client.requested_urls), [1, 2, 3])
+
+    def test_exact_multiple(self):
+        client = PaginatedFakeGitlabClient(200)
+        self.assertEqual(len(client.get(self.URL)), 200)
+        self.assertEqual(len(client.requested_urls), 2)
+
+    def test_next_page(self):
+        client = PaginatedFakeGitlabClient(250, mode='next')
+        users = client.get(self.URL)
+        self.assertEqual([i['id'] for i in users], list(range(250)))
+        self.assertEqual(len(client.requested_urls), 3)
+
+    def test_keyset_link(self):
+        client = PaginatedFakeGitlabClient(250, mode='keyset')
+        users = client.get(self.URL)
+        self.assertEqual([i['id'] for i in users], list(range(250)))
+        self.assertEqual(len(client.requested_urls), 3)
+
+    def test_iter_keyset(self):
+        client = PaginatedFakeGitlabClient(250, mode='keyset')
+        users = client.iter_keyset(self.URL)
+        self.assertEqual(client.requested_urls, [])
+        self.assertEqual(next(users), {'id': 0})
+        self.assertEqual(client.requested_urls[0][1]['pagination'], 'keyset')
+        self.assertEqual(
+            [i['id'] for i in users], list(range(1, 250)))
+        self.assertEqual(len(client.requested_urls), 3)
+
+
 class GitlabinstanceTestCase(unittest.TestCase):
     def setUp(self):
         self.client = FakeGitlabClient()
@@ -20,6 +67,30 @@ class GitlabinstanceTestCase(unittest.TestCase):
         self.assertEqual(
             gitlab.check_users_exist([]), True)
 
+    def test_lazy_users_index(self):
+        gitlab = GitlabInstance('http://localhost:3000/api/v3', self.client)
+        requested = []
+        get = self.client.get
+
+        def logged_get(url, params=None):
+            requested.append(params['username'])
+            return get(url, params)
+        self.client.get = logged_get
+
+        users = gitlab.get_lazy_users_index()
+        users.prefetch(['john_smith', 'babar'])
+        self.assertEqual(sorted(requested), ['babar', 'john_smith'])
+
+        self.assertIn('john_smith', users)
+        self.assertNotIn('babar', users)
+        self.assertEqual(users['jack_smith']['id'], 2)
+        self.assertEqual(users.get('babar'), None)
+        with self.assertRaises(KeyError):
+            users['babar']
+
+        # hits and misses are memoized
+        self.assertEqual(sorted(requested), ['babar', 'jack_smith', 'john_smith'])
+
 
 class GitlabprojectTestCase(unittest.TestCase):
     def setUp(self):
@@ -52,3 +123,201 @@ class GitlabprojectTestCase(unittest.TestCase):
         self.assertEqual(
             self.project_1.has_members([]),
             True)
+
+
+class GitlabProjectResolutionTestCase(unittest.TestCase):
+    URL = 'http://localhost:3000/diaspora/diaspora-project-site'
+
+    def setUp(self):
+        self.client = FakeGitlabClient()
+        self.requested_urls = []
+        get = self.client.get
+
+        def logged_get(url):
+            self.requested_urls.append(url)
+            return get(url)
+        self.client.get = logged_get
+
+    def test_direct_lookup(self):
+        project = GitlabProject(self.URL, self.client)
+        self.assertEqual(project.project_id, 3)
+        self.assertEqual(self.requested_urls, [
+            'http://localhost:3000/api/v4/projects/diaspora%2Fdiaspora-project-site'])
+
+    def test_listing_fallback(self):
+        def not_found(url):
+            if 'diaspora%2F' in url:
+                raise HTTPError(response=make_response({}, status_code=404))
+            return FakeGitlabClient.get(self.client, url)
+        self.client.get = not_found
+
+        project = GitlabProject(self.URL, self.client)
+        self.assertEqual(project.project_id, 3)
+        self.assertIsNone(project.group_id)
+
+    def test_id_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            GitlabProject(self.URL, self.client, id_cache=IdCache.in_dir(cache_dir))
+            self.assertEqual(len(self.requested_urls), 1)
+
+            # a new invocation reads ids from disk
+            project = GitlabProject(
+                self.URL, self.client, id_cache=IdCache.in_dir(cache_dir))
+            self.assertEqual(len(self.requested_urls), 1)
+            self.assertEqual(project.project_id, 3)
+            self.assertTrue(
+                os.path.exists(os.path.join(cache_dir, IdCache.FILENAME)))
+
+
+class GitlabIssueCreationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.project = GitlabProject(
+            'http://localhost:3000/diaspora/diaspora-project-site',
+            FakeGitlabClient())
+        self.client = RecordingGitlabClient()
+        self.project.api = self.client
+
+    def make_meta(self, notes=(), fake_sudo=None):
+        return {
+            'uploads': [],
+            'notes': list(notes),
+            'must_close': True,
+            'fake_sudo': fake_sudo,
+        }
+
+    def test_sudo(self):
+        meta = self.make_meta(notes=[
+            ({'body': 'a'}, {'sudo_user': 'jack_smith'}),
+            ({'body': 'b'}, {'sudo_user': None}),
+        ])
+        meta['sudo_user'] = 'john_smith'
+        self.project.create_issue({'title': 'foo'}, meta)
+
+        headers = [r[2]['headers'] for r in self.client.requests]
+        self.assertEqual(
+            [h.get('SUDO') for h in headers],
+            ['john_smith', 'jack_smith', None, None])
+        self.assertTrue(all(h['PRIVATE-TOKEN'] == 'admin-key' for h in headers))
+
+    def test_fake_sudo_does_not_alter_client(self):
+        meta = self.make_meta(
+            notes=[({'body': 'a'}, {'fake_sudo': 'jack-key'})],
+            fake_sudo='john-key')
+        self.project.create_issue({'title': 'foo'}, meta)
+        self.project.create_watcher({'name': 'eye'}, {'fake_sudo': None}, 1)
+
+        self.assertEqual(
+            [r[2]['headers']['PRIVATE-TOKEN'] for r in self.client.requests],
+            ['john-key', 'jack-key', 'john-key', 'admin-key'])
+        self.assertEqual(self.client.api_key, 'admin-key')
+
+    def test_on_created(self):
+        request = self.client.request
+
+        def failing_notes(method, url, **kwargs):
+            if url.endswith('/notes'):
+                return make_response({}, status_code=400)
+            return request(method, url, **kwargs)
+        self.client.request = failing_notes
+
+        created = []
+        with self.assertRaises(HTTPError):
+            self.project.create_issue(
+                {'title': 'foo'}, self.make_meta([({'body': 'a'}, {})]),
+                created.append)
+        # known as created, even though its notes failed
+        self.assertEqual([i['iid'] for i in created], [1])
+
+    def test_concurrent_notes(self):
+        self.client.latency = 0.02
+        self.project.note_workers = 10
+        notes = [({'body': str(i), 'created_at': str(i)},
+                  {'fake_sudo': 'key-{}'.format(i % 2)})
+                 for i in range(20)]
+
+        start = time.perf_counter()
+        self.project.create_issue({'title': 'foo'}, self.make_meta(notes))
+        elapsed = time.perf_counter() - start
+
+        note_requests = [r for r in self.client.requests
+                         if r[1].endswith('/notes')]
+        self.assertEqual(
+            sorted(int(r[2]['data']['body']) for r in note_requests),
+            list(range(20)))
+        for r in note_requests:
+            self.assertEqual(
+                r[2]['headers']['PRIVATE-TOKEN'],
+                'key-{}'.format(int(r[2]['data']['body']) % 2))
+        self.assertLess(elapsed, 20 * 0.02)
+
+    def test_concurrent_uploads(self):
+        self.client.latency = 0.02
+        project = GitlabProject(
+            'http://localhost:3000/diaspora/diaspora-project-site',
+            FakeGitlabClient(), upload_workers=10)
+        project.api = self.client
+        uploads = [{'filename': 'f{}.png'.format(i),
+                    'content_url': 'http://redmine/attachments/{}'.format(i),
+                    'content_type': 'image/png',
+                    'description': 'd{}'.format(i)}
+                   for i in range(10)]
+
+        start = time.perf_counter()
+        pending = project.submit_uploads(uploads)
+        text = project.uploads_to_string(uploads, pending)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(
+            [line.split('](')[0] for line in text.split('\n  * ')],
+            ['![f{}.png'.format(i) for i in range(10)])
+        self.assertTrue(text.endswith(' d9'))
+        self.assertLess(elapsed, 10 * 2 * 0.02)
+
+    def test_attachment_cache(self):
+        downloads = []
+
+        def open_attachment(url):
+            downloads.append(url)
+            return io.BytesIO(b'release notes')
+        self.client.open = open_attachment
+
+        uploads = [{'id': i, 'digest': 'abc', 'filename': 'notes.txt',
+                    'content_url': 'http://redmine/attachments/{}'.format(i),
+                    'content_type': 'text/plain', 'description': ''}
+                   for i in (1, 2)]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for run in range(2):
+                project = GitlabProject(
+                    'http://localhost:3000/diaspora/diaspora-project-site',
+                    FakeGitlabClient(),
+                    attachment_cache=AttachmentCache.in_dir(cache_dir))
+                project.api = self.client
+                text = project.uploads_to_string(uploads)
+                self.assertEqual(text.count('/uploads/1/notes.txt'), 2)
+
+        # downloaded once per attachment, uploaded once per content
+        self.assertEqual(len(downloads), 2)
+        self.assertEqual(
+            len([r for r in self.client.requests if r[1].endswith('/uploads')]),
+            1)
+
+    def test_upload_retry_does_not_download_again(self):
+        downloads = []
+
+        def open_attachment(url):
+            downloads.append(url)
+            return io.BytesIO(b'x' * 100000)
+        self.client.open = open_attachment
+        self.client.failing_uploads = 1
+
+        text = self.project.uploads_to_string([{
+            'filename': 'r\xe9sum\xe9.txt', 'description': '',
+            'content_url': 'http://redmine/attachments/1',
+            'content_type': 'text/plain'}])
+
+        self.assertEqual(len(downloads), 1)
+        self.assertEqual(len(self.client.uploaded), 2)
+        for body in self.client.uploaded:
+            self.assertIn(b'x' * 100000, body)
+        self.assertIn('r sum .txt', text)
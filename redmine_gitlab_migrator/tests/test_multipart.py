@@ -0,0 +1,57 @@
+import email.parser
+import io
+import tempfile
+import tracemalloc
+import unittest
+
+import requests
+
+from redmine_gitlab_migrator.multipart import MultipartFile, copy_stream
+
+
+class MultipartFileTestCase(unittest.TestCase):
+    def test_body(self):
+        body = MultipartFile(
+            'file', 'a "b".txt', io.BytesIO(b'foo\r\nbar'), 'text/plain')
+        raw = b''.join(body)
+        self.assertEqual(len(raw), len(body))
+        self.assertEqual(b''.join(body), raw)
+
+        message = email.parser.BytesParser().parsebytes(
+            'Content-Type: {}\r\n\r\n'.format(
+                body.headers['Content-Type']).encode() + raw)
+        part, = message.get_payload()
+        self.assertEqual(part.get_filename(), 'a %22b%22.txt')
+        self.assertEqual(part.get_content_type(), 'text/plain')
+        self.assertEqual(part.get_payload(decode=True), b'foo\r\nbar')
+
+    def test_streamed_by_requests(self):
+        body = MultipartFile(
+            'file', 'foo.bin', io.BytesIO(b'x' * 1000), 'application/octet-stream')
+        prepared = requests.Request(
+            'POST', 'http://localhost/uploads', data=body,
+            headers=body.headers).prepare()
+
+        self.assertIs(prepared.body, body)
+        self.assertEqual(prepared.headers['Content-Length'], str(len(body)))
+        self.assertTrue(prepared.headers['Content-Type'].startswith(
+            'multipart/form-data; boundary='))
+
+    def test_memory(self):
+        size = 32 * 1024 * 1024
+        with tempfile.TemporaryFile() as f:
+            copy_stream(io.BytesIO(b'\0' * 1024 * 1024), f)
+            f.seek(size - 1)
+            f.write(b'\0')
+
+            tracemalloc.start()
+            try:
+                body = MultipartFile('file', 'core', f, 'application/octet-stream')
+                sent = sum(len(chunk) for chunk in body)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        self.assertEqual(sent, len(body))
+        self.assertGreater(sent, size)
+        self.assertLess(peak, 4 * MultipartFile.CHUNK_SIZE)
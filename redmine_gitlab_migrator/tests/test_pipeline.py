@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+
+from redmine_gitlab_migrator.pipeline import imap, imap_fair
+
+
+class ImapTestCase(unittest.TestCase):
+    def test_ordered(self):
+        def slow_for_small(i):
+            time.sleep(0.01 * (5 - i))
+            return i * 2
+
+        self.assertEqual(
+            list(imap(slow_for_small, range(5), workers=5)),
+            [0, 2, 4, 6, 8])
+
+    def test_unordered(self):
+        def slow_for_small(i):
+            time.sleep(0.05 * (3 - i))
+            return i
+
+        results = list(imap(slow_for_small, range(3), workers=3, ordered=False))
+        self.assertEqual(results, [2, 1, 0])
+
+    def test_bounded_buffer(self):
+        pulled = []
+
+        def source():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+
+        results = imap(lambda i: i, source(), workers=2, buffer_size=4)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(pulled), 5)
+        self.assertEqual(list(results), list(range(1, 100)))
+
+    def test_error(self):
+        def fail_on_two(i):
+            if i == 2:
+                raise ValueError(i)
+            return i
+
+        results = imap(fail_on_two, range(5), workers=2)
+        self.assertEqual(next(results), 0)
+        self.assertEqual(next(results), 1)
+        with self.assertRaises(ValueError):
+            next(results)
+
+    def test_stages_overlap(self):
+        latency = 0.02
+        threads = set()
+
+        def stage(i):
+            threads.add(threading.current_thread().name)
+            time.sleep(latency)
+            return i
+
+        start = time.perf_counter()
+        results = list(
+            imap(stage, imap(stage, imap(stage, range(10)))))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(results, list(range(10)))
+        # stages run at the same time: close to 10 items at the pace of a
+        # single stage, instead of 3 * 10
+        self.assertLess(elapsed, 20 * latency)
+        self.assertEqual(len(threads), 3)
+
+
+class ImapFairTestCase(unittest.TestCase):
+    def test_throttled_items_deferred(self):
+        ready_at = time.perf_counter() + 0.1
+
+        def delay(item):
+            if item.startswith('john'):
+                return max(0, ready_at - time.perf_counter())
+            return 0
+
+        results = list(imap_fair(
+            lambda i: i, ['john-1', 'jack-1', 'john-2', 'jack-2'], delay,
+            workers=1))
+
+        self.assertEqual(results, ['jack-1', 'jack-2', 'john-1', 'john-2'])
+
+    def test_workers(self):
+        start = time.perf_counter()
+        results = list(imap_fair(
+            lambda i: time.sleep(0.05) or i, range(8), lambda i: 0,
+            workers=4))
+        self.assertEqual(sorted(results), list(range(8)))
+        self.assertLess(time.perf_counter() - start, 0.3)
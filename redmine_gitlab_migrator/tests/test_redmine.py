@@ -1,6 +1,13 @@
+import tempfile
+import time
 import unittest
 
-from .fake import FakeRedmineClient
+from requests import HTTPError
+
+from .fake import (
+    FakeRedmineClient, PaginatedFakeRedmineClient, SlowFakeRedmineClient,
+    make_response)
+from redmine_gitlab_migrator.cache import SnapshotStore
 from redmine_gitlab_migrator.redmine import RedmineProject
 
 
@@ -17,6 +24,57 @@ class RedmineTestCase(unittest.TestCase):
         self.assertEqual(len(issues[0].get('journals', [])), 2)
         self.assertEqual(len(issues[1].get('journals', [])), 0)
 
+    def test_iter_issues(self):
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client, fetch_workers=1)
+        issues = project.iter_issues()
+        self.assertEqual(next(issues)['id'], 1439)
+        self.assertEqual(next(issues)['id'], 1732)
+        self.assertEqual(list(issues), [])
+
+    def test_get_issues_memory_limit(self):
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client, memory_limit=1024)
+        issues = project.get_all_issues()
+        self.assertTrue(issues.spilled)
+        self.assertEqual([i['id'] for i in issues], [1439, 1732])
+        self.assertEqual(len(project.get_participants()), 2)
+
+    def test_lazy_users_index(self):
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client)
+        users = project.get_lazy_users_index()
+        self.assertEqual(users[83]['login'], 'john_smith')
+        self.assertIn(3, users)
+        self.assertNotIn(2, users)
+        with self.assertRaises(KeyError):
+            users[2]
+        self.assertEqual(len(users.values()), 2)
+
+    def test_get_issues_id_range(self):
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client, initial_id=1500)
+        requested = []
+        get = self.client.get
+
+        def logged_get(url, params=None):
+            requested.append(url)
+            return get(url, params)
+        self.client.get = logged_get
+
+        issues = project.get_all_issues()
+        self.assertEqual([i['id'] for i in issues], [1732])
+        self.assertEqual(len([i for i in requested if '/issues/' in i]), 1)
+
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client, max_id=1500)
+        self.assertEqual([i['id'] for i in project.get_all_issues()], [1439])
+
     def test_get_participants(self):
         project_1 = RedmineProject(
             'http://localhost:9000/projects/diaspora-site',
@@ -30,6 +88,41 @@ class RedmineTestCase(unittest.TestCase):
         self.assertIn('@', project_1.get_participants()[0]['mail'])
         self.assertEqual(len(project_2.get_participants()), 0)
 
+    def test_get_participants_memoized(self):
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client)
+        requested = []
+        get = self.client.get
+
+        def logged_get(url, params=None):
+            requested.append(url)
+            return get(url, params)
+        self.client.get = logged_get
+
+        participants = project.get_participants()
+        self.assertEqual([i['id'] for i in participants], [3, 83])
+        requests_count = len(requested)
+
+        project.get_users_index()
+        project.get_participants()
+        self.assertEqual(len(requested), requests_count)
+
+    def test_get_users_not_admin(self):
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client)
+        get = self.client.get
+
+        def forbidden_get(url, params=None):
+            if url.endswith('/users.json'):
+                raise HTTPError(response=make_response({}, status_code=403))
+            return get(url, params)
+        self.client.get = forbidden_get
+
+        users = project.get_users({3, 83})
+        self.assertEqual([i['login'] for i in users], ['jack_smith', 'john_smith'])
+
     def test_get_versions(self):
         project = RedmineProject(
             'http://localhost:9000/projects/diaspora-site',
@@ -42,3 +135,119 @@ class RedmineTestCase(unittest.TestCase):
             self.client)
         self.assertEqual(
             project.public_url, 'http://localhost:9000/projects/diaspora-site')
+
+
+class RedmineSnapshotTestCase(unittest.TestCase):
+    URL = 'http://localhost:9000/projects/diaspora-site'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = SnapshotStore.in_dir(self.tmp_dir.name)
+        self.client = FakeRedmineClient()
+        self.requested = []
+        get = self.client.get
+
+        def logged_get(url, params=None):
+            self.requested.append(url)
+            return get(url, params)
+        self.client.get = logged_get
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_fresh_issues_not_refetched(self):
+        project = RedmineProject(self.URL, self.client, store=self.store)
+        self.assertEqual(len(project.get_all_issues()), 2)
+        self.assertEqual(
+            len([i for i in self.requested if '/issues/' in i]), 2)
+
+        self.requested.clear()
+        project = RedmineProject(self.URL, self.client, store=self.store)
+        self.assertEqual(
+            [i['id'] for i in project.get_all_issues()], [1439, 1732])
+        self.assertEqual(self.requested, [])
+
+    def test_offline(self):
+        project = RedmineProject(self.URL, self.client, store=self.store)
+        project.get_participants()
+        project.get_versions()
+
+        self.requested.clear()
+        self.client.unpaginated_get = None
+        project = RedmineProject(
+            self.URL, self.client, store=self.store, offline=True)
+        self.assertEqual(len(project.get_all_issues()), 2)
+        self.assertEqual(len(project.get_participants()), 2)
+        self.assertEqual(len(project.get_versions()), 2)
+        self.assertEqual(self.requested, [])
+
+    def test_delta(self):
+        listings = []
+        unpaginated_get = self.client.unpaginated_get
+
+        def logged_unpaginated_get(url, params=None):
+            listings.append(params)
+            return unpaginated_get(url, params)
+        self.client.unpaginated_get = logged_unpaginated_get
+
+        project = RedmineProject(
+            self.URL, self.client, store=self.store, delta=True)
+        self.assertEqual(len(project.get_all_issues()), 2)
+        self.assertNotIn('updated_on', listings[-1])
+        self.assertIsNone(project.updated_ids)
+
+        project = RedmineProject(
+            self.URL, self.client, store=self.store, delta=True)
+        issues = project.get_all_issues()
+        self.assertEqual(listings[-1]['updated_on'], '>=2015-09-09T15:54:49Z')
+        # unchanged issues come from the snapshot
+        self.assertEqual([i['id'] for i in issues], [1439, 1732])
+        self.assertEqual(project.updated_ids, {1732})
+
+    def test_offline_requires_store(self):
+        with self.assertRaises(ValueError):
+            RedmineProject(self.URL, self.client, offline=True)
+
+
+class RedmineClientTestCase(unittest.TestCase):
+    def test_unpaginated_get(self):
+        client = PaginatedFakeRedmineClient(250, page_workers=3)
+        issues = client.unpaginated_get('http://localhost:9000/issues.json')
+        self.assertEqual(client.requested_offsets, [0])
+        self.assertEqual([i['id'] for i in issues], list(range(250)))
+        self.assertEqual(sorted(client.requested_offsets), [0, 100, 200])
+
+    def test_unpaginated_get_single_page(self):
+        client = PaginatedFakeRedmineClient(100)
+        issues = client.unpaginated_get('http://localhost:9000/issues.json')
+        self.assertEqual(len(list(issues)), 100)
+        self.assertEqual(client.requested_offsets, [0])
+
+
+class RedmineBenchmarkTestCase(unittest.TestCase):
+    LATENCY = 0.1
+
+    def setUp(self):
+        self.client = SlowFakeRedmineClient(latency=self.LATENCY)
+
+    def time_get_all_issues(self, fetch_workers):
+        project = RedmineProject(
+            'http://localhost:9000/projects/diaspora-site',
+            self.client, fetch_workers=fetch_workers)
+        start = time.perf_counter()
+        issues = project.get_all_issues()
+        return time.perf_counter() - start, issues
+
+    def test_concurrent_fetch(self):
+        sequential_time, sequential_issues = self.time_get_all_issues(1)
+        concurrent_time, concurrent_issues = self.time_get_all_issues(2)
+
+        # listing + 2 details vs listing + 2 concurrent details
+        self.assertGreaterEqual(sequential_time, 3 * self.LATENCY)
+        self.assertLess(concurrent_time, 2.9 * self.LATENCY)
+        self.assertEqual(
+            [i['id'] for i in concurrent_issues],
+            [i['id'] for i in sequential_issues])
+        self.assertEqual(
+            [i['id'] for i in concurrent_issues], [1439, 1732])
@@ -0,0 +1,176 @@
+import threading
+import time
+import unittest
+
+from redmine_gitlab_migrator.throttle import (
+    AdaptiveLimiter, SingleFlight, TokenBucket)
+
+from .fake import ScriptedClient, make_response
+
+
+class AdaptiveLimiterTestCase(unittest.TestCase):
+    def run_window(self, limiter, latency=0.01, concurrency=None):
+        """ Sends a window of requests, ``concurrency`` at a time
+        """
+        concurrency = concurrency or limiter.limit
+        for _ in range(0, limiter.window, concurrency):
+            tokens = [limiter.acquire() for _ in range(concurrency)]
+            for token in tokens:
+                limiter.release(token, latency)
+
+    def test_increase_when_saturated(self):
+        limiter = AdaptiveLimiter('host', initial=2, maximum=4, window=4)
+        self.run_window(limiter)
+        self.assertEqual(limiter.limit, 3)
+        self.run_window(limiter)
+        self.run_window(limiter)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_no_increase_when_unsaturated(self):
+        limiter = AdaptiveLimiter('host', initial=2, window=4)
+        self.run_window(limiter, concurrency=1)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_decrease_once_per_burst(self):
+        limiter = AdaptiveLimiter('host', initial=8, maximum=8)
+        tokens = [limiter.acquire() for _ in range(4)]
+        for token in tokens:
+            limiter.release(token, 0.01, ok=False)
+        self.assertEqual(limiter.limit, 4)
+
+        limiter.release(limiter.acquire(), 0.01, ok=False)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_decrease_on_latency(self):
+        limiter = AdaptiveLimiter('host', initial=4, maximum=4, window=4)
+        self.run_window(limiter, latency=0.01)
+        self.assertEqual(limiter.limit, 4)
+        self.run_window(limiter, latency=0.1)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_blocks_above_limit(self):
+        limiter = AdaptiveLimiter('host', initial=1)
+        token = limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+        threading.Thread(target=acquire).start()
+
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(token, 0.01)
+        self.assertTrue(acquired.wait(1))
+
+    def test_client_limiter_per_host(self):
+        client = ScriptedClient([
+            make_response({}, status_code=503),
+            make_response({}),
+        ], adaptive=True)
+        limiter = client.get_limiter('gitlab.example.com')
+        limiter.limit = 4
+        client.get('https://gitlab.example.com/api/v4/users')
+
+        self.assertEqual(limiter.limit, 2)
+        self.assertIsNot(client.get_limiter('redmine.example.com'), limiter)
+        self.assertIsNone(ScriptedClient([]).get_limiter('gitlab.example.com'))
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(rate=50, burst=2)
+        start = time.perf_counter()
+        for _ in range(7):
+            bucket.take()
+        # 2 at once, then one every 20ms
+        self.assertAlmostEqual(time.perf_counter() - start, 0.1, delta=0.05)
+        self.assertGreater(bucket.delay(), 0)
+
+    def test_drain(self):
+        bucket = TokenBucket(rate=100)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.drain(0.5)
+        self.assertAlmostEqual(bucket.delay(), 0.5, delta=0.05)
+
+
+class IdentityThrottlingTestCase(unittest.TestCase):
+    URL = 'https://gitlab.example.com/api/v4/projects/1/issues'
+
+    def test_rate_limited_identity(self):
+        client = ScriptedClient([
+            make_response({}, {'Retry-After': '0.2'}, status_code=429),
+            make_response({'id': 1}),
+        ], identity_rate=100)
+
+        self.assertEqual(client.post(self.URL, {}, api_key='john-key'), {'id': 1})
+        (_, _, first), (_, _, second) = client.requests
+        self.assertGreaterEqual(second - first, 0.2)
+
+        # neither the host, nor the other identities are held
+        self.assertEqual(client._paused_until, {})
+        self.assertEqual(client.identity_delay('jack-key'), 0)
+        self.assertIsNone(client.get_bucket('key'))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def run_concurrently(self, single_flight, func, count=5):
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(single_flight.do('key', func)))
+            for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_shared_call(self):
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.1)
+            return {'id': 1}
+
+        single_flight = SingleFlight()
+        results = self.run_concurrently(single_flight, func)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'id': 1}] * 5)
+        self.assertTrue(all(r is results[0] for r in results))
+
+        # not memoized
+        single_flight.do('key', func)
+        self.assertEqual(len(calls), 2)
+
+    def test_shared_error(self):
+        def func():
+            time.sleep(0.1)
+            raise ValueError()
+
+        single_flight = SingleFlight()
+        errors = []
+
+        def call():
+            try:
+                single_flight.do('key', func)
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(errors), 3)
+
+    def test_memo(self):
+        calls = []
+        single_flight = SingleFlight(ttl=0.1)
+        func = lambda: calls.append(1) or len(calls)
+
+        self.assertEqual(single_flight.do('key', func), 1)
+        self.assertEqual(single_flight.do('key', func), 1)
+        time.sleep(0.1)
+        self.assertEqual(single_flight.do('key', func), 2)
+        single_flight.clear()
+        self.assertEqual(single_flight.do('key', func), 3)
@@ -0,0 +1,269 @@
+""" Flow control of the requests sent to the APIs
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class Slot:
+    """ Outcome of a request sent within a limiter slot
+    """
+    ok = True
+
+
+class AdaptiveLimiter:
+    """ Limit of the concurrent requests to a host, adjusted on the fly (AIMD)
+
+    The limit is raised by one after each window of healthy requests during
+    which it was reached, and halved on failures (rate limiting, server
+    errors, connection errors) or when the p95 latency rises well above the
+    lowest seen. Requests sent before a decrease do not count anymore, so
+    that a burst of errors only halves the limit once.
+    """
+    # Number of requests between two latency checks
+    WINDOW = 20
+    # p95 latency above baseline * LATENCY_FACTOR is considered an overload
+    LATENCY_FACTOR = 2
+    # Slow upward drift of the baseline, so that a lasting slowdown of the
+    # server ends up being accepted
+    BASELINE_DRIFT = 1.05
+
+    def __init__(self, name, initial=2, maximum=10, minimum=1, window=WINDOW):
+        self.name = name
+        self.limit = min(initial, maximum)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._epoch = 0
+        self._latencies = []
+        self._saturated = False
+        self._baseline = None
+
+    def acquire(self):
+        """ Waits for a free slot
+
+        :return: token to give back to release()
+        """
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+            if self._in_flight >= self.limit:
+                self._saturated = True
+            return self._epoch
+
+    def release(self, token, latency, ok=True):
+        """ Frees a slot, accounting for the request outcome
+
+        :param token: as returned by acquire()
+        :param latency: duration of the request, in seconds
+        :param ok: False if the request failed because of the server load
+        """
+        with self._cond:
+            self._in_flight -= 1
+            if not ok:
+                if token == self._epoch:
+                    self._decrease('request failed')
+            elif token == self._epoch:
+                self._latencies.append(latency)
+                if len(self._latencies) >= self.window:
+                    self._check_window()
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """ Context manager holding a slot while sending a request
+
+        The request is considered as failed if an exception is raised, or
+        if ``ok`` is set to False on the yielded Slot.
+        """
+        token = self.acquire()
+        slot = Slot()
+        start = time.perf_counter()
+        try:
+            yield slot
+        except Exception:
+            slot.ok = False
+            raise
+        finally:
+            self.release(token, time.perf_counter() - start, slot.ok)
+
+    def _check_window(self):
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+
+        if (self._baseline is not None
+                and p95 > self._baseline * self.LATENCY_FACTOR):
+            self._decrease('p95 latency {:.3f}s, baseline {:.3f}s'.format(
+                p95, self._baseline))
+        elif self._saturated and self.limit < self.maximum:
+            self.limit += 1
+            log.info('{}: concurrency raised to {} (p95 latency {:.3f}s)'.format(
+                self.name, self.limit, p95))
+
+        if self._baseline is None:
+            self._baseline = p95
+        else:
+            self._baseline = min(p95, self._baseline * self.BASELINE_DRIFT)
+        self._reset_window()
+
+    def _decrease(self, reason):
+        limit = max(self.minimum, self.limit // 2)
+        if limit != self.limit:
+            log.info('{}: concurrency lowered to {} ({})'.format(
+                self.name, limit, reason))
+        self.limit = limit
+        self._epoch += 1
+        self._reset_window()
+
+    def _reset_window(self):
+        self._latencies = []
+        self._saturated = self._in_flight >= self.limit
+
+
+class TokenBucket:
+    """ Allows ``rate`` operations per second, up to ``burst`` at once
+
+    Thread-safe.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """ Returns how long to wait for a token, 0 if one is available
+        """
+        with self._lock:
+            self._refill()
+            return max(0, (1 - self._tokens) / self.rate)
+
+    def take(self):
+        """ Takes a token, waiting for one if needed
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def drain(self, delay):
+        """ Empties the bucket, next token being available in ``delay`` seconds
+
+        Used when the server tells the rate limit is exhausted.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 1 - delay * self.rate)
+
+
+class LatencyStats:
+    """ Recent latencies of requests, per endpoint
+
+    Thread-safe.
+    """
+    # Number of latencies kept per endpoint
+    WINDOW = 100
+    # Number of latencies needed before estimating percentiles
+    MIN_SAMPLES = 20
+
+    def __init__(self, window=WINDOW, min_samples=MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, latency):
+        with self._lock:
+            self._latencies[endpoint].append(latency)
+
+    def percentile(self, endpoint, percent):
+        """ Returns a percentile of the endpoint latencies
+
+        :return: a duration in seconds, None if too few were observed
+        """
+        with self._lock:
+            latencies = sorted(self._latencies[endpoint])
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[int(percent / 100 * (len(latencies) - 1))]
+
+
+class SingleFlight:
+    """ Runs concurrent calls with the same key once, sharing their result
+
+    The result of a call can also be memoized for ``ttl`` seconds, serving
+    the next calls with the same key.
+
+    Thread-safe.
+    """
+    # Number of memoized results above which expired ones are purged
+    MEMO_PURGE_SIZE = 1000
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._memo = {}
+
+    def do(self, key, func):
+        """ Returns func(), or the result of a running call with the same key
+        """
+        with self._lock:
+            if self.ttl and key in self._memo:
+                expires, result = self._memo[key]
+                if expires > time.monotonic():
+                    return result
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = self._calls[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._calls[key]
+            if self.ttl:
+                self._memoize(key, result)
+        future.set_result(result)
+        return result
+
+    def _memoize(self, key, result):
+        now = time.monotonic()
+        if len(self._memo) >= self.MEMO_PURGE_SIZE:
+            self._memo = {k: v for k, v in self._memo.items() if v[0] > now}
+        self._memo[key] = (now + self.ttl, result)
+
+    def clear(self):
+        """ Forgets the memoized results
+        """
+        with self._lock:
+            self._memo.clear()
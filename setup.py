@@ -20,6 +20,9 @@ setup(
     url='https://github/oasiswork/migrate-redmine-to-gitlab/',
     packages=['redmine_gitlab_migrator'],
     install_requires=['requests', 'pyyaml', 'gitpython', 'pypandoc', 'peewee', 'psycopg2-binary'],
+    extras_require={
+        'async': ['aiohttp'],
+    },
     entry_points={
         'console_scripts': [
             'migrate-rg = redmine_gitlab_migrator.commands:main'